@@ -1,7 +1,8 @@
 """ CIP-API Authentication module """
 
-import requests
 from gel_report_config import *
+import http_session
+import token_cache
 
 
 class APIAuthentication:
@@ -18,18 +19,31 @@ class APIAuthentication:
 		
 
     def get_token(self):
+		# return the cached token, only requesting a new one if it has expired (or is about to expire)
+		return token_cache.get_cache().get(self.cache_key(), self.request_token)
+
+
+    def refresh_token(self, rejected_token=None):
+		# discard a token the API has rejected (eg with a 401) and get a new one. Defaults to this object's token
+		token_cache.get_cache().invalidate(self.cache_key(), rejected_token or self.token)
+		self.token = self.get_token()
+		return self.token
+
+
+    def cache_key(self):
+		# tokens are cached per token url and username file (username is defined in gel_report_config)
+		return self.token_url + "|" + username
+
+
+    def request_token(self):
 		# read username from file (username is defined in gel_report_config)
 		with open(username,'r') as f:
 			user=f.readline()
 		#read password from file (pw is defined in gel_report_config)
 		with open(pw,'r') as f:
 			password=f.readline()
-		# use requests module to submit the credentials and return the token
-		# if proxy is set in the config file:
-		if proxy:
-			return requests.post(self.token_url, {"username": user, "password":password},proxies=proxy).json()["token"]
-		else:
-			return requests.post(self.token_url, {"username": user, "password":password}).json()["token"]
+		# use the shared requests session (which applies any proxy set in the config file) to submit the credentials and return the token
+		return http_session.post(self.token_url, {"username": user, "password":password}).json()["token"]
 
 
 if __name__ == "__main__":
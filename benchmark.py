@@ -0,0 +1,405 @@
+'''
+benchmark.py
+This script measures how long it takes to create clinical reports, end to end, without needing the CIP-API or the LIMS.
+
+A local stand-in for the CIP-API is started which issues tokens (/get-token/), answers interpretation request queries and serves clinical reports.
+The reports are synthetic (a report with a coverage table of a given number of rows, for each size in -s) or recorded reports saved from the CIP-API (-r).
+The LIMS is replaced by a SQLite database containing a patient for each proband.
+Requests for https://cipapi.genomicsengland.nhs.uk are redirected to the local server, so the same code paths are used as in a real run (including the token cache, shared session, LIMS connection pool and render pool).
+
+Each report is created using gel_report.py (with -w reports created at once), which records the time taken by each stage (see timing.py).
+At the end the latency of each stage, the throughput (reports/minute) and the peak memory use are printed (and optionally written to a json file, eg to compare runs before and after a change).
+'''
+import sys
+import getopt
+import os
+import json
+import time
+import base64
+import shutil
+import sqlite3
+import tempfile
+import resource
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from multiprocessing.pool import ThreadPool
+
+from requests.adapters import HTTPAdapter
+
+# Import local settings
+import gel_report_config as config # config file
+import GEL_logo as gel_logo
+import authentication
+import http_session
+import lims
+from gel_report import connect
+
+
+# the CIP-API host which is redirected to the local server
+cipapi_host = "https://cipapi.genomicsengland.nhs.uk"
+
+# synthetic report sizes: the number of rows in the coverage table
+report_sizes = {"small": 50, "medium": 2000, "large": 20000}
+
+# the LIMS stand-in table, and the query used to read a patient from it
+lims_table = "CREATE TABLE Patients (GELParticipantID TEXT PRIMARY KEY, NHSNumber TEXT, InternalPatientID TEXT, DOB TEXT, FirstName TEXT, LastName TEXT, Gender TEXT, Clinician TEXT, ClinicAddress TEXT)"
+lims_query = "SELECT NHSNumber, InternalPatientID, DOB, FirstName, LastName, Gender, Clinician, ClinicAddress FROM Patients WHERE GELParticipantID = ?"
+
+
+def synthetic_report(proband_id, rows):
+	'''Returns a clinical report, laid out as the CIP-API reports are, with a coverage table of the given number of rows'''
+	coverage = "\n".join(["<tr><td>GENE%s</td><td>chr1:%s</td><td>%s.5</td><td>30x</td></tr>" % (row, row * 1000, row) for row in range(rows)])
+	return """<!DOCTYPE html>
+<html>
+<head>
+<style>
+.banner {
+    background-color: #007C83; /*#27b7cc;*/
+}
+</style>
+</head>
+<body>
+<div class="over-header content-div"><span class="left">GeL Proband ID: %(proband_id)s</span><span class="right">Generated on: 2017-06-01</span></div>
+<div class="banner">
+%(logo)s
+<div class="banner-text">Whole Genome Analysis Rare Disease Primary Findings</div>
+</div>
+<div class="content-div">
+<p class="note">Genomics England, Queen Mary University of London, Dawson Hall</p>
+<table class="form-table" cellpadding="0">
+<tr><td>Referring clinician</td><td>Dr X</td></tr>
+<tr><td>Link to clinical summary</td><td><a href="https://cipapi.genomicsengland.nhs.uk/%(proband_id)s">%(proband_id)s</a></td></tr>
+<tr><td>Report version</td><td>1</td></tr>
+</table>
+<h3>Participant Information</h3>
+<table class="table"><tr><td>Sex</td><td>Male</td></tr></table>
+</div>
+<div class="content-div"><a onclick="toggle()" style="cursor:pointer">Coverage Metrics</a>
+<div id="coverage" hidden>
+<table><thead><tr><th>Gene</th><th>Locus</th><th>Coverage</th><th>Note</th></tr></thead><tbody>
+%(coverage)s
+</tbody></table>
+</div></div>
+</body>
+</html>
+""" % {"proband_id": proband_id, "logo": gel_logo.gel_logo_code, "coverage": coverage}
+
+
+def fake_token(lifetime=3600):
+	'''Returns an (unsigned) JWT which expires after lifetime seconds, so the token cache treats it as a real token'''
+	payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + lifetime})).rstrip("=")
+	return "eyJhbGciOiJub25lIn0." + payload + ".benchmark"
+
+
+class FakeCIPAPI(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''Local stand-in for the CIP-API, serving a report for each proband in reports'''
+	daemon_threads = True
+
+	def __init__(self, reports, latency=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeCIPAPIHandler)
+		# proband ID: report html
+		self.reports = reports
+		# seconds added to each response, to simulate the network
+		self.latency = latency
+		self.url = "http://127.0.0.1:%s" % self.server_address[1]
+
+	def case(self, proband_id):
+		'''The interpretation request json for a proband, as returned by the CIP-API'''
+		return {"interpretation_request_id": "%s-1" % proband_id,
+				"proband": proband_id,
+				"cip": config.CIP,
+				"sites": ["RJ1"],
+				"clinical_reports": [{"url": "%s/api/ClinicalReport/%s/1/1/1" % (cipapi_host, proband_id)}],
+				"interpreted_genomes": [{"cip_version": 1}]}
+
+
+class FakeCIPAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# keep connections open between requests, as the CIP-API does
+	protocol_version = "HTTP/1.1"
+	# send each response as soon as it is written, otherwise the latency is dominated by delayed ACKs
+	disable_nagle_algorithm = True
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.getheader("content-length") or 0))
+		if self.path.startswith("/api/get-token/"):
+			self.respond(200, json.dumps({"token": fake_token()}), "application/json")
+		else:
+			self.respond(404, "not found", "text/plain")
+
+	def do_GET(self):
+		time.sleep(self.server.latency)
+		if not (self.headers.getheader("authorization") or "").startswith("JWT "):
+			self.respond(401, json.dumps({"detail": "Authentication credentials were not provided."}), "application/json")
+			return
+
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url.query)
+		if url.path == "/api/2/interpretation-request" and "members" in query:
+			proband_id = query["members"][0]
+			results = [self.server.case(proband_id)] if proband_id in self.server.reports else []
+			self.respond(200, json.dumps({"count": len(results), "next": None, "results": results}), "application/json")
+		elif url.path.startswith("/api/ClinicalReport/") and url.path.split("/")[3] in self.server.reports:
+			self.respond(200, self.server.reports[url.path.split("/")[3]], "text/html")
+		else:
+			self.respond(404, "not found", "text/plain")
+
+	def respond(self, status, body, content_type):
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# don't print every request
+		pass
+
+
+class RedirectAdapter(HTTPAdapter):
+	'''Sends requests for the CIP-API to the local server instead'''
+	def __init__(self, server_url, **kwargs):
+		self.server_url = server_url
+		HTTPAdapter.__init__(self, **kwargs)
+
+	def send(self, request, **kwargs):
+		request.url = request.url.replace(cipapi_host, self.server_url, 1)
+		return HTTPAdapter.send(self, request, **kwargs)
+
+
+class SQLitePool(lims.ConnectionPool):
+	'''LIMS connection pool using the SQLite stand-in database'''
+	def connect(self):
+		return sqlite3.connect(self.connect_string, check_same_thread=False)
+
+
+class benchmark_connect(connect):
+	'''gel_report.connect, reading the patient information from the LIMS stand-in'''
+	def read_interpretation_request(self, sample):
+		# parse_json calls this but gel_report.py doesn't define it yet; nothing is needed from the interpretation request for the report
+		pass
+
+	def read_lims(self, sites):
+		NHS, InternalPatientID, DOB, FName, LName, Gender, clinician, clinic_address = self.fetchone(lims_query, [self.proband_id])
+		return {"NHS": NHS, "InternalPatientID": InternalPatientID, "dob": DOB, "firstname": FName, "lastname": LName, "gender": Gender, "clinician": clinician, "clinician_add": clinic_address, "report_title": "Whole Genome Sequencing Report", "copies": ""}
+
+
+class benchmark():
+	def __init__(self):
+		# Usage example
+		self.usage = "python benchmark.py [-n <reports per size>] [-s small,medium,large | -r <report.html>,<report.html>] [-w <workers>] [-l <latency ms>] [-p <wkhtmltopdf path>] [-c] [-h True/False] [-o <results.json>]"
+
+		# number of reports to create of each size (or from each recorded report)
+		self.reports_per_size = 10
+
+		# synthetic report sizes to use (see report_sizes)
+		self.sizes = ["small", "medium", "large"]
+
+		# recorded reports to serve instead of synthetic reports
+		self.recorded_reports = []
+
+		# number of reports to create at once
+		self.workers = config.batch_workers
+
+		# seconds added to each API response
+		self.latency = 0
+
+		# wkhtmltopdf to render the reports with
+		self.wkhtmltopdf_path = config.wkhtmltopdf_path
+
+		# use the report cache and pdf store (otherwise every report is downloaded and rendered)
+		self.use_caches = False
+
+		# flag passed on to each report (see gel_report.py)
+		self.remove_headers = "True"
+
+		# optional file to write the results to
+		self.results_file = ""
+
+	def take_inputs(self, argv):
+		'''Capture the benchmark settings from the command line'''
+		# define expected inputs
+		try:
+			opts, args = getopt.getopt(argv, "n:s:r:w:l:p:ch:o:", ['number=', 'sizes=', 'recorded=', 'workers=', 'latency=', 'wkhtmltopdf=', 'caches', 'removeheader=', 'output='])
+		# raise errors with usage eg
+		except getopt.GetoptError:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		# loop through the arguments
+		for opt, arg in opts:
+			if opt in ("-n", "--number"):
+				self.reports_per_size = int(arg)
+			if opt in ("-s", "--sizes"):
+				self.sizes = arg.split(",")
+			if opt in ("-r", "--recorded"):
+				self.recorded_reports = arg.split(",")
+			if opt in ("-w", "--workers"):
+				self.workers = int(arg)
+			if opt in ("-l", "--latency"):
+				self.latency = float(arg) / 1000
+			if opt in ("-p", "--wkhtmltopdf"):
+				self.wkhtmltopdf_path = str(arg)
+			if opt in ("-c", "--caches"):
+				self.use_caches = True
+			if opt in ("-h", "--removeheader"):
+				self.remove_headers = str(arg)
+			if opt in ("-o", "--output"):
+				self.results_file = str(arg)
+
+		if [size for size in self.sizes if size not in report_sizes]:
+			print "ERROR - sizes must be from %s" % ",".join(sorted(report_sizes))
+			sys.exit(2)
+
+		results = self.run()
+		self.print_results(results)
+		if self.results_file:
+			with open(self.results_file, "w") as file:
+				json.dump(results, file, indent=4, sort_keys=True)
+
+	def make_reports(self):
+		'''Returns a dictionary of proband ID: report html, and of proband ID: report name (the size or recorded report)'''
+		reports = {}
+		names = {}
+		proband_id = 100000000
+		if self.recorded_reports:
+			sources = [(os.path.basename(path), open(path, "r").read()) for path in self.recorded_reports]
+		else:
+			sources = [(size, report_sizes[size]) for size in self.sizes]
+
+		for name, source in sources:
+			for i in range(self.reports_per_size):
+				proband_id += 1
+				reports[str(proband_id)] = source if self.recorded_reports else synthetic_report(proband_id, source)
+				names[str(proband_id)] = name
+		return reports, names
+
+	def make_lims(self, path, proband_ids):
+		'''Create the LIMS stand-in database with a patient for each proband'''
+		cnxn = sqlite3.connect(path)
+		cnxn.execute(lims_table)
+		cnxn.executemany("INSERT INTO Patients VALUES (?,?,?,?,?,?,?,?,?)",
+			[(proband_id, "999" + proband_id[-7:], "P" + proband_id, "01/01/2000", "Firstname", "Lastname", "Female", "Dr Clinician", "Clinical Genetics, Guy's Hospital") for proband_id in proband_ids])
+		cnxn.commit()
+		cnxn.close()
+
+	def configure(self, work_dir, server):
+		'''Point the settings at the working directory, local server and LIMS stand-in'''
+		app_dir = os.path.dirname(os.path.abspath(__file__)) + "/"
+		config.new_patientinfo_table = app_dir + "patient_info_table_template.html"
+		config.new_clinician_table = app_dir + "referring_clinic_table_template.html"
+		config.html_reports = work_dir + "html/"
+		config.pdf_dir = work_dir + "pdf/"
+		os.makedirs(config.pdf_dir)
+		config.wkhtmltopdf_path = self.wkhtmltopdf_path
+		config.token_cache = work_dir + "token_cache.json"
+		config.report_cache_dir = work_dir + "report_cache/" if self.use_caches else None
+		config.pdf_store_dir = work_dir + "pdf_store/" if self.use_caches else None
+		config.http_pool_size = max(self.workers, config.http_pool_size)
+		# the timings are collected here rather than written to the timing log
+		config.timing_log = None
+		# the local server must not be reached through the proxy
+		config.proxy = None
+
+		# the credentials are only sent to the local server
+		authentication.username = work_dir + "username.txt"
+		authentication.pw = work_dir + "pw.txt"
+		for path in (authentication.username, authentication.pw):
+			with open(path, "w") as file:
+				file.write("benchmark")
+
+		http_session.get_session().mount(cipapi_host, RedirectAdapter(server.url, pool_maxsize=config.http_pool_size))
+		lims.set_pool(SQLitePool(work_dir + "lims.db", size=self.workers))
+
+	def run(self):
+		'''Create all the reports, returning the results'''
+		reports, names = self.make_reports()
+		work_dir = tempfile.mkdtemp(prefix="gel_report_benchmark_") + "/"
+		server = FakeCIPAPI(reports, self.latency)
+		server_thread = threading.Thread(target=server.serve_forever)
+		server_thread.daemon = True
+		server_thread.start()
+		try:
+			self.make_lims(work_dir + "lims.db", reports.keys())
+			self.configure(work_dir, server)
+			token = authentication.APIAuthentication().token
+
+			print "creating %s reports with %s workers" % (len(reports), self.workers)
+			start = time.time()
+			pool = ThreadPool(max(1, self.workers))
+			try:
+				reports_timed = pool.map(self.run_proband, [(token, proband_id) for proband_id in sorted(reports)])
+			finally:
+				pool.close()
+				pool.join()
+			elapsed = time.time() - start
+		finally:
+			server.shutdown()
+			server.server_close()
+			lims.close_pool()
+			shutil.rmtree(work_dir, True)
+
+		failed = [proband_id for proband_id, timings, error in reports_timed if error]
+		results = {"reports": len(reports),
+				"failed": len(failed),
+				"workers": self.workers,
+				"seconds": elapsed,
+				"reports_per_minute": (len(reports) - len(failed)) * 60 / elapsed,
+				"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+				"peak_render_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+				"errors": dict([(proband_id, error) for proband_id, timings, error in reports_timed if error]),
+				"stage_order": [],
+				"stages": {}}
+
+		# the stages in the order they happen (each modification of the report is a separate stage)
+		for proband_id, timings, error in reports_timed:
+			results["stage_order"] += [stage for stage in timings if stage not in results["stage_order"]]
+
+		# latency of each stage, for each report size
+		for name in sorted(set(names.values())):
+			results["stages"][name] = {}
+			for stage in results["stage_order"]:
+				times = sorted([timings[stage] for proband_id, timings, error in reports_timed if names[proband_id] == name and not error and stage in timings])
+				if times:
+					results["stages"][name][stage] = {"mean": sum(times) / len(times), "median": percentile(times, 50), "p95": percentile(times, 95), "max": times[-1]}
+		return results
+
+	def run_proband(self, token_and_proband_id):
+		'''Create the report for a single proband. Returns the proband ID, the time taken by each stage and any error'''
+		token, proband_id = token_and_proband_id
+		c = benchmark_connect(token)
+		c.remove_headers = self.remove_headers
+		c.set_proband(proband_id)
+		start = time.time()
+		try:
+			if not c.generate_report():
+				return proband_id, c.timer.stages, c.error or "no report created"
+		except (Exception, SystemExit) as e:
+			return proband_id, c.timer.stages, c.error or repr(e)
+		c.timer.add("total", time.time() - start)
+		return proband_id, c.timer.stages, None
+
+	def print_results(self, results):
+		'''Print the latency of each stage and the overall throughput'''
+		print "\nreport\tstage\tmean ms\tmedian ms\tp95 ms\tmax ms"
+		for name in sorted(results["stages"]):
+			for stage in results["stage_order"]:
+				if stage in results["stages"][name]:
+					times = results["stages"][name][stage]
+					print "%s\t%s\t%.1f\t%.1f\t%.1f\t%.1f" % (name, stage, times["mean"] * 1000, times["median"] * 1000, times["p95"] * 1000, times["max"] * 1000)
+
+		for proband_id in sorted(results["errors"]):
+			print "FAILED %s: %s" % (proband_id, results["errors"][proband_id].replace("\n", " "))
+		print "\n%s reports (%s failed) in %.1f seconds with %s workers: %.1f reports/minute" % (results["reports"], results["failed"], results["seconds"], results["workers"], results["reports_per_minute"])
+		print "peak memory: %.1f MB (largest wkhtmltopdf process %.1f MB)" % (results["peak_rss_mb"], results["peak_render_rss_mb"])
+
+
+def percentile(times, percent):
+	'''The value below which percent of the (sorted) times fall'''
+	return times[min(len(times) - 1, int(len(times) * percent / 100.0))]
+
+
+if __name__=="__main__":
+	b=benchmark()
+	b.take_inputs(sys.argv[1:])
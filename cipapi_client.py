@@ -0,0 +1,178 @@
+"""
+Client for making many CIP-API requests at once, eg checking the interpretation request and report status of
+thousands of probands during reconciliation.
+
+This code runs on Python 2, so asyncio (and aiohttp/httpx) aren't available. Instead the requests are made by a bounded
+pool of threads which share the keep-alive session (http_session.py) and cached token (token_cache.py); the threads
+spend almost all their time waiting on the network, so this gives the same overlap of requests.
+"""
+from multiprocessing.pool import ThreadPool
+
+import gel_report_config as config
+import generic_methods
+import http_session
+import report_cache
+from authentication import APIAuthentication
+from shared import bounded_map
+
+
+# interpretation requests for a CIP and proband which are ready to be reported
+interpretation_list_url = "https://cipapi.genomicsengland.nhs.uk/api/2/interpretation-request?cip={cip}&status=sent_to_gmcs%2Creport_generated%2Creport_sent&members={proband}&format=json"
+
+# all interpretation requests for a CIP which are ready to be reported (any proband), a page at a time
+interpretation_sweep_url = "https://cipapi.genomicsengland.nhs.uk/api/2/interpretation-request?cip={cip}&status=sent_to_gmcs%2Creport_generated%2Creport_sent&page_size={page_size}&format=json"
+
+
+class ConcurrentCIPAPIClient(object):
+    """
+    Makes CIP-API requests for many probands, members or reports at once, with at most <concurrency> requests in flight
+    """
+
+    def __init__(self, token=None, concurrency=None):
+        """
+        :param token: an existing CIP-API token. If None one is taken from APIAuthentication (which uses the token cache)
+        :param concurrency: the maximum number of requests in flight (defaults to api_concurrency in the config file)
+        """
+
+        self.token = token or APIAuthentication().token
+        self.concurrency = concurrency or getattr(config, 'api_concurrency', 8)
+
+    def get(self, url, headers=None):
+        """
+        GET a CIP-API url; if the token is rejected (401) a new token is requested and the request tried once more
+
+        :param url:
+        :param headers: any headers to send as well as the authorisation header
+        :return: a requests.Response
+        """
+
+        headers = dict(headers or {})
+        token = self.token
+        headers["Authorization"] = "JWT " + token  # note space is required after JWT
+        response = http_session.get(url, headers=headers)
+        if response.status_code == 401:
+            self.token = APIAuthentication().refresh_token(token)
+            headers["Authorization"] = "JWT " + self.token
+            response = http_session.get(url, headers=headers)
+
+        # 304 is returned when revalidating a cached report (see report_cache.py)
+        if response.status_code not in (200, 304):
+            raise ValueError(
+                "Received status: {status} for url: {url} with response: {response}".format(
+                    status=response.status_code, url=url, response=response.content)
+            )
+        return response
+
+    def get_json(self, url):
+        """
+        GET a CIP-API url and return the json
+
+        :param url:
+        :return:
+        """
+
+        return self.get(url).json()
+
+    def map(self, function, items):
+        """
+        call function(item) for each (unique) item, with at most <concurrency> calls running at once.
+        An error for one item doesn't stop the others
+
+        :param function:
+        :param items:
+        :return: a dictionary of item: result, and a dictionary of item: error message for the items which failed
+        """
+
+        return bounded_map(function, items, self.concurrency)
+
+    def interpretation_requests(self, proband_ids, cip=None):
+        """
+        the interpretation request list (as used by gel_report.read_API_page) for each proband
+
+        :param proband_ids:
+        :param cip: defaults to the CIP in the config file
+        :return: a dictionary of proband_id: json, and a dictionary of proband_id: error message
+        """
+
+        cip = cip or config.CIP
+        return self.map(lambda proband_id: self.get_json(interpretation_list_url.format(cip=cip, proband=proband_id)),
+                        proband_ids)
+
+    def sweep_interpretation_requests(self, cip=None, page_size=None, prefetch=None):
+        """
+        generator of every interpretation request for the CIP which is ready to be reported (for any proband).
+        Pages are fetched as they are needed by following the API's next links; if prefetch is True the next page
+        is downloaded in the background while the current page is used
+
+        :param cip: defaults to the CIP in the config file
+        :param page_size: results per page (defaults to sweep_page_size in the config file)
+        :param prefetch: defaults to sweep_prefetch in the config file
+        :return: a generator of interpretation request json
+        """
+
+        url = interpretation_sweep_url.format(cip=cip or config.CIP,
+                                              page_size=page_size or getattr(config, 'sweep_page_size', 100))
+        if prefetch is None:
+            prefetch = getattr(config, 'sweep_prefetch', True)
+
+        prefetcher = ThreadPool(1) if prefetch else None
+        try:
+            page = self.get_json(url)
+            while page:
+                next_url = page.get('next')
+                next_page = None
+                if prefetcher and next_url:
+                    next_page = prefetcher.apply_async(self.get_json, (next_url,))
+
+                for result in page['results']:
+                    yield result
+
+                if next_page:
+                    page = next_page.get()
+                elif next_url:
+                    page = self.get_json(next_url)
+                else:
+                    page = None
+        finally:
+            if prefetcher:
+                prefetcher.terminate()
+
+    def sweep_probands(self, cip=None, page_size=None, prefetch=None):
+        """
+        generator of the proband IDs with an interpretation request for the CIP which is ready to be reported
+        (see sweep_interpretation_requests). Each proband is only given once
+
+        :return: a generator of proband IDs
+        """
+
+        seen = set()
+        for interpretation_request in self.sweep_interpretation_requests(cip, page_size, prefetch):
+            proband_id = str(interpretation_request['proband'])
+            if proband_id not in seen:
+                seen.add(proband_id)
+                yield proband_id
+
+    def clinical_reports(self, report_urls):
+        """
+        download the clinical report html for each report url, using the report cache if it is set up
+
+        :param report_urls:
+        :return: a dictionary of report_url: html, and a dictionary of report_url: error message
+        """
+
+        cache = report_cache.get_cache()
+        if cache is None:
+            return self.map(lambda report_url: self.get(report_url).content, report_urls)
+        return self.map(lambda report_url: cache.fetch(report_url, self.get, report_cache.without_errors), report_urls)
+
+    def member_lookups(self, member_ids, details):
+        """
+        the interpretation requests and versions for each member (see generic_methods.recent_ir_and_version_from_members_with_details).
+        Members already in the member index (member_index.py) aren't looked up again
+
+        :param member_ids:
+        :param details: the cip api credentials dict
+        :return: a dictionary of member_id: {ir: details}, and a dictionary of member_id: error message
+        """
+
+        return generic_methods.recent_ir_and_version_from_members_with_details(member_ids, details, self.concurrency)
@@ -0,0 +1,99 @@
+'''
+compare_parsers.py
+This script checks that the modified report is the same whichever parser beautiful soup uses to read it (see html_parser in the config file).
+
+Each saved clinical report given is modified (as gel_report.py does, with placeholder patient information) using every parser which is installed,
+and the result is compared to that from python's built in html.parser. Differences in whitespace between tags are ignored as they don't change the pdf.
+'''
+import sys
+import getopt
+from itertools import izip_longest
+
+from gel_report import connect
+
+
+# the parsers beautiful soup can use. html.parser is built in and is the reference the others are compared to
+parsers = ["html.parser", "lxml", "html5lib"]
+
+# placeholder patient information used to fill in the templates
+patient_info_dict = {"NHS":"NHS", "InternalPatientID":"InternalPatientID", "dob":"dob", "firstname":"firstname", "lastname":"lastname", "gender":"gender", "clinician":"clinician", "clinician_add":"clinician_add", "report_title":"report_title", "copies":""}
+
+
+class compare():
+	def __init__(self):
+		# Usage example
+		self.usage = "python compare_parsers.py -h True/False <report.html> [<report.html> ...]"
+
+		# flag passed to the report (see gel_report.py)
+		self.remove_headers = ""
+
+	def take_inputs(self, argv):
+		'''Capture the reports to check from the command line'''
+		# define expected inputs
+		try:
+			opts, args = getopt.getopt(argv, "h:", ['removeheader='])
+		# raise errors with usage eg
+		except getopt.GetoptError:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		for opt, arg in opts:
+			if opt in ("-h", "--removeheader"):
+				self.remove_headers = str(arg)
+
+		if not args:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		# exit with an error if any report differs
+		if not all([self.check_report(report) for report in args]):
+			sys.exit(1)
+
+	def available_parsers(self):
+		'''Returns the parsers which are installed'''
+		available = []
+		for parser in parsers:
+			try:
+				if parser != "html.parser":
+					__import__(parser)
+				available.append(parser)
+			except ImportError:
+				print "%s is not installed" % parser
+		return available
+
+	def modify(self, report, parser):
+		'''Returns the modified report html using this parser'''
+		# a placeholder token is used as the API isn't read
+		c = connect("placeholder")
+		c.remove_headers = self.remove_headers
+		c.html_parser = parser
+		return c.modify_report(report, patient_info_dict)
+
+	def normalise(self, html):
+		'''Remove whitespace between tags (and blank lines) which can differ between parsers without changing the pdf'''
+		return [line.strip() for line in html.splitlines() if line.strip()]
+
+	def check_report(self, report_path):
+		'''Compare the modified report from each parser to html.parser. Returns True if they are all the same'''
+		with open(report_path, "r") as file:
+			report = file.read()
+
+		reference = self.normalise(self.modify(report, "html.parser"))
+		same = True
+		for parser in self.available_parsers()[1:]:
+			modified = self.normalise(self.modify(report, parser))
+			if modified == reference:
+				print "%s\t%s\tsame" % (report_path, parser)
+			else:
+				same = False
+				# report the first line which is different
+				for line_number, (expected, found) in enumerate(izip_longest(reference, modified)):
+					if expected != found:
+						print "%s\t%s\tDIFFERENT at line %s:\n\thtml.parser: %s\n\t%s: %s" % (report_path, parser, line_number + 1, str(expected)[:200], parser, str(found)[:200])
+						break
+		return same
+
+
+if __name__=="__main__":
+	c=compare()
+	c.take_inputs(sys.argv[1:])
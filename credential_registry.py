@@ -0,0 +1,161 @@
+"""
+Credentials for the GEL services, read from the YAML environment file (see example_credentials.yaml)
+
+The file was read and parsed on every call to the generic_methods credential functions, which adds up when looping over
+many members. The registry parses each file once (with the C safe loader if libyaml is installed) and only reads it
+again when its modification time (or size) changes. It also hands out an authenticated session for each set of
+credentials, so callers don't build a header for every request.
+"""
+import copy
+import os
+import threading
+
+import yaml
+
+import http_session
+from shared import SharedInstance
+
+
+# the fastest safe loader available (CSafeLoader needs libyaml)
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# the registry shared by the whole process, created on first use
+_registry = SharedInstance(lambda: CredentialRegistry())
+
+
+class CredentialRegistry(object):
+    """
+    Parsed credential files, by path, reloaded when a file changes
+    """
+
+    def __init__(self):
+        # path: (modification time, size, {name: credentials})
+        self.files = {}
+        # (path, name): CIPAPISession
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def credentials(self, env_path):
+        """
+        all the credential sets in a file, by name
+
+        :param env_path: the YAML environment file
+        :return: dictionary of name: credentials dict (copies, so they can be changed by the caller)
+        """
+
+        return copy.deepcopy(self._load(env_path))
+
+    def credentials_by_name(self, env_path, name):
+        """
+        the credential set with this name
+
+        :param env_path: the YAML environment file
+        :param name: eg cip_api
+        :return: the credentials dict (a copy)
+        """
+
+        return copy.deepcopy(self._load(env_path)[name])
+
+    def session(self, env_path, name):
+        """
+        an authenticated session for the CIP-API credentials with this name. The same session is returned until the
+        credentials in the file change
+
+        :param env_path: the YAML environment file
+        :param name: eg cip_api
+        :return: a CIPAPISession
+        """
+
+        credentials = self._load(env_path)[name]
+        with self.lock:
+            session = self.sessions.get((env_path, name))
+            if session is None or session.credentials != credentials:
+                session = CIPAPISession(copy.deepcopy(credentials))
+                self.sessions[(env_path, name)] = session
+            return session
+
+    def _load(self, env_path):
+        """ the parsed file, read again if it has changed since it was last read """
+        try:
+            stat = os.stat(env_path)
+        except (OSError, TypeError):
+            raise ValueError('The stated file for environment login credentials doesn\'t exist: {}'.format(env_path))
+
+        with self.lock:
+            cached = self.files.get(env_path)
+            if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+                return cached[2]
+
+            with open(env_path) as env_file:
+                cred_dict = yaml.load(env_file, Loader=SafeLoader)
+
+            # repackage the list of dictionaries as a dictionary of dictionaries - reference credentials by name
+            credentials = {entry['name']: entry for entry in cred_dict}
+            self.files[env_path] = (stat.st_mtime, stat.st_size, credentials)
+            return credentials
+
+
+class CIPAPISession(object):
+    """
+    Makes requests to a CIP-API with a set of credentials, adding the authorisation header (the token is cached, see
+    token_cache.py) and requesting a new token if it is rejected
+    """
+
+    def __init__(self, credentials):
+        """
+        :param credentials: the credentials dict (host, username and password)
+        """
+
+        self.credentials = credentials
+
+    def url(self, path):
+        """ urls starting with / are relative to the host """
+        return self.credentials['host'] + path if path.startswith('/') else path
+
+    def get(self, url, **kwargs):
+        """
+        GET a url; if the token is rejected (401) a new token is requested and the request tried once more
+
+        :param url: the full url, or a path on the host starting with /
+        :return: a requests.Response
+        """
+
+        # imported here as generic_methods uses this module
+        import generic_methods
+
+        url = self.url(url)
+        headers = dict(kwargs.pop('headers', None) or {})
+        header = generic_methods.get_cipapi_header_from_credentials(self.credentials)
+        headers.update(header)
+        response = http_session.get(url, headers=headers, **kwargs)
+
+        if response.status_code == 401:
+            headers.update(generic_methods.refresh_cipapi_header_from_credentials(self.credentials, header))
+            response = http_session.get(url, headers=headers, **kwargs)
+        return response
+
+    def get_json(self, url):
+        """
+        GET a url, returning the result as JSON
+
+        :param url: the full url, or a path on the host starting with /
+        :return:
+        """
+
+        response = self.get(url)
+        if response.status_code != 200:
+            raise ValueError(
+                "Received status: {status} for url: {url} with response: {response}".format(
+                    status=response.status_code, url=self.url(url), response=response.content)
+            )
+        return response.json()
+
+
+def get_registry():
+    """
+    returns the registry shared by the whole process
+
+    :return: a CredentialRegistry
+    """
+
+    return _registry.get()
@@ -0,0 +1,113 @@
+"""
+Single pass rewrite engine for beautiful soup documents
+
+Each modification to the report is registered as a rule: a tag name, optional attributes to match, and a handler.
+The document is walked once and every matching rule is applied to each tag in document order, rather than each
+modification searching the whole document with its own find_all.
+
+Handlers are called with the matching tag. A handler can return REMOVE to have the tag removed from the document;
+removals are made once the walk is complete, so other rules can still read the tag and its contents.
+Finalisers are called once the removals have been made, eg to capture html which other rules may have changed.
+"""
+
+
+# returned by a handler to remove the tag once the walk is complete
+REMOVE = 'remove'
+
+
+class Rule(object):
+    """
+    A handler to call for tags with this name (or all tags if name is None) which have the given attributes
+    """
+
+    def __init__(self, name, handler, attrs=None):
+        self.name = name
+        self.handler = handler
+        self.attrs = attrs or {}
+
+    def matches(self, tag):
+        """
+        True if the tag has all of the rule's attributes. As with find_all, a class matches either one of the
+        tag's classes or its whole class string (eg {'class': 'content-div error-panel'})
+
+        :param tag:
+        :return:
+        """
+
+        for attr, value in self.attrs.items():
+            actual = tag.get(attr)
+            if actual is None:
+                return False
+            if isinstance(actual, list):
+                if value not in actual and value != ' '.join(actual):
+                    return False
+            elif actual != value:
+                return False
+        return True
+
+
+class RewriteEngine(object):
+    """
+    A set of rules applied to a document in a single walk
+    """
+
+    def __init__(self):
+        # tag name: rules for that tag (None for rules which apply to all tags), in the order they were added
+        self.rules = {}
+        self.finalisers = []
+
+    def add_rule(self, name, handler, attrs=None):
+        """
+        call handler(tag) for each tag with this name and attributes. Rules for the same tag are applied in the order added
+
+        :param name: the tag name, or None for any tag
+        :param handler:
+        :param attrs: dictionary of attributes the tag must have
+        """
+
+        self.rules.setdefault(name, []).append(Rule(name, handler, attrs))
+
+    def add_finaliser(self, finaliser):
+        """
+        call finaliser() once the walk is complete and removals have been made
+
+        :param finaliser:
+        """
+
+        self.finalisers.append(finaliser)
+
+    def apply(self, soup, timer=None):
+        """
+        walk the document once, applying the rules to every tag
+
+        :param soup: a BeautifulSoup object
+        :param timer: optional StageTimer (see timing.py); the time spent in each handler is recorded under its name
+        :return: the modified soup
+        """
+
+        any_tag_rules = self.rules.get(None, [])
+        to_remove = []
+
+        for tag in soup.find_all(True):
+            # skip tags an earlier handler has taken out of the document (eg by unwrapping or replacing its parent's contents)
+            if tag.parent is None:
+                continue
+
+            for rule in self.rules.get(tag.name, []) + any_tag_rules:
+                if rule.matches(tag) and self.call(rule.handler, timer, tag) == REMOVE:
+                    to_remove.append(tag)
+
+        for tag in to_remove:
+            tag.extract()
+
+        for finaliser in self.finalisers:
+            self.call(finaliser, timer)
+
+        return soup
+
+    def call(self, function, timer, *args):
+        """ call a handler or finaliser, timing it if there is a timer """
+        if timer is None:
+            return function(*args)
+        with timer.stage(function.__name__):
+            return function(*args)
@@ -7,29 +7,108 @@ This report is then modified to make it clear that this report has not been issu
 Hopefully this solves a problem faced by many labs and prevents too much duplication of work!
 Created 02/06/2017 by Aled Jones
 '''
-import requests
 from bs4 import BeautifulSoup
-import pdfkit
-import pyodbc
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment
+from StringIO import StringIO
 import sys
 import getopt
+import threading
+import bisect
 
 # Import local settings
 from authentication import APIAuthentication # import the function from the authentication script which generates the access token
 import gel_report_config as config # config file 
 from database_connection_config import * # database connection details
 import GEL_logo as gel_logo
+import http_session # shared requests session (keeps connections to the CIP-API open between requests)
+import cipapi_client
+import report_cache
+import dom_rewrite
+import pdf_render
+import lims # pooled LIMS database connections
+import sync_state
+import timing # time (and optionally profile) each stage
+import retry_queue # reports with an error panel to try again later
+import work_queue # state of each report in a batch
+
+
+def default_html_parser():
+	'''Returns the parser for beautiful soup to use: html_parser from the config file if set, otherwise lxml if it is installed (much faster on large reports), otherwise python's built in html.parser'''
+	if getattr(config, "html_parser", None):
+		return config.html_parser
+	try:
+		import lxml
+		return "lxml"
+	except ImportError:
+		return "html.parser"
+
+
+# Jinja environment shared by all reports. keep_trailing_newline so a rendered template can be put into the report as it is
+jinja_env = Environment(keep_trailing_newline=True)
+
+# compiled templates, by (template path, without copies line)
+templates = {}
+templates_lock = threading.Lock()
+
+def load_template(path, without_copies=False):
+	'''Returns the Jinja template in this file, which is only read and compiled the first time it is used.
+	If without_copies is True the <p>cc.{{copies}}</p> line is left out (for when there are no copies to list)'''
+	key = (path, without_copies)
+	if key not in templates:
+		with templates_lock:
+			if key not in templates:
+				with open(path, "r") as template:
+					lines = template.readlines()
+				if without_copies:
+					lines = [line for line in lines if not line.startswith("<p>cc.{{copies}}</p>")]
+				# the templates are utf-8 encoded, so decode them before passing to Jinja
+				templates[key] = jinja_env.from_string("".join(lines).decode("utf-8"))
+	return templates[key]
+
+class background_call(threading.Thread):
+	'''Calls function(*args) in a separate thread. result() waits for it to finish and returns its return value, or raises its exception (including SystemExit from quit())'''
+	def __init__(self, function, *args):
+		threading.Thread.__init__(self)
+		# don't stop the script exiting if the result is never needed
+		self.daemon = True
+		self.function = function
+		self.args = args
+		self.value = None
+		self.exc_info = None
+		self.start()
+
+	def run(self):
+		try:
+			self.value = self.function(*self.args)
+		except BaseException:
+			self.exc_info = sys.exc_info()
+
+	def result(self):
+		self.join()
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.value
+
+def render_template(path, patient_info_dict, without_copies=False):
+	'''Returns the template populated with the patient information, utf-8 encoded to match the html from beautiful soup'''
+	return load_template(path, without_copies).render(patient_info_dict).encode("utf-8")
 
 
 class connect():
-	def __init__(self):
-		# call function to retrieve the api token
-		self.token=APIAuthentication().get_token()
+	def __init__(self, token=None):
+		# records how long each stage takes (written to the timing log in the config file)
+		self.timer = timing.StageTimer()
+
+		# call function to retrieve the api token (unless one is provided eg when running in batch mode)
+		if token:
+			self.token = token
+		else:
+			with self.timer.stage("auth"):
+				self.token=APIAuthentication().token
 	
 		# The link to the first page of the CIP API results
-		self.interpretationlist = "https://cipapi.genomicsengland.nhs.uk/api/2/interpretation-request?cip={cip}&status=sent_to_gmcs%2Creport_generated%2Creport_sent&members={proband}&format=json"
+		self.interpretationlist = cipapi_client.interpretation_list_url
 		
 		# The probandID to return the report for
 		self.proband_id = ""
@@ -39,7 +118,7 @@ class connect():
 		self.pdf_report = ""
 		
 		# Usage example
-		self.usage = "python gel_report.py -g <GELParticipantID> -h True/False"
+		self.usage = "python gel_report.py -g <GELParticipantID> -h True/False [-p cprofile]"
 		
 		# Header line to remove
 		self.old_header = "Genomics England, Queen Mary University of London,"
@@ -71,12 +150,40 @@ class connect():
 		
 		# create a variable to hold the various cip versions
 		self.max_cip_ver = 0
-	
+
+		# reason a report could not be created (used in the batch summary)
+		self.error = ""
+
+		# the LIMS record for the proband, if it has been fetched in bulk (see read_lims)
+		self.lims_record = None
+
+		# the batch's work queue, updated as the report progresses (see work_queue.py)
+		self.work_queue = None
+
+		# the parser beautiful soup uses to read the report
+		self.html_parser = default_html_parser()
+
+		# record of the inputs each pdf was created from (see sync_state.py). If set, the pdf is only created if the inputs have changed
+		self.sync_state = None
+
+		# set if the pdf wasn't created again because its inputs haven't changed since the last sync
+		self.unchanged = False
+
+		# profile the report (see timing.profilers); the results are written next to the pdf
+		self.profile = ""
+
+		# the downloaded report and the patient information from the LIMS (see fetch_report)
+		self.report = None
+		self.patient_info_dict = None
+
+		# the inputs the pdf is created from, recorded in the sync state
+		self.sync_inputs = None
+
 	def take_inputs(self, argv):	
 		'''Capture the gel participant ID from the command line'''
 		# define expected inputs
 		try:
-			opts, args = getopt.getopt(argv, "g:h:", ['gelid', 'removeheader'])
+			opts, args = getopt.getopt(argv, "g:h:p:", ['gelid=', 'removeheader=', 'profile='])
 		# raise errors with usage eg
 		except getopt.GetoptError:
 			print "ERROR - correct usage is", self.usage
@@ -91,20 +198,65 @@ class connect():
 			if opt in ("-h", "--removeheader"):
 				# If this flag is given don't touch the report header.
 				self.remove_headers = str(arg)
+			
+			if opt in ("-p", "--profile"):
+				# profile creating the report
+				self.profile = str(arg)
 				
 		if self.proband_id:
-			#build paths to reports
-			self.htmlfilename = self.proband_id + ".html"
-			self.html_report = config.html_reports + self.htmlfilename
-			self.pdf_report = config.pdf_dir + self.proband_id + ".pdf"
-			
-			
-	
-			# Call the function to read the API
+			# build paths to reports
+			self.set_proband(self.proband_id)
+			# create the report
+			self.generate_report()
+
+	def set_proband(self, proband_id):
+		'''Set the proband ID and build the paths to the reports'''
+		self.proband_id = str(proband_id)
+		#build paths to reports
+		self.htmlfilename = self.proband_id + ".html"
+		self.html_report = config.html_reports + self.htmlfilename
+		self.pdf_report = config.pdf_dir + self.proband_id + ".pdf"
+
+	def generate_report(self):
+		'''Read the API and create the report for the proband. Returns True if a pdf was created.
+		The time taken by each stage is written to the timing log (if set in the config file), and if self.profile is set the whole report is profiled'''
+		status = "failed"
+		error = ""
+		try:
+			if self.profile:
+				created = timing.profile(self.profile, config.pdf_dir + self.proband_id, self.read_and_parse)
+			else:
+				created = self.read_and_parse()
+			if created:
+				status = "unchanged" if self.unchanged else "created"
+			return created
+		# read_lims calls quit() if the patient can't be found so record SystemExit as well
+		except (Exception, SystemExit) as e:
+			error = repr(e)
+			raise
+		finally:
+			self.timer.write(self.proband_id, status, self.error or error)
+
+	def queue_retry(self, error):
+		'''Record why the report couldn't be created and queue the proband to be tried again later (if retry_queue_db is set in the config file, see retry_queue.py)'''
+		self.error = error
+		queue = retry_queue.get_queue()
+		if queue:
+			next_attempt = queue.add(self.proband_id, error)
+			if next_attempt:
+				self.error += ", will retry after %s" % datetime.fromtimestamp(next_attempt).strftime("%Y-%m-%d %H:%M")
+			else:
+				self.error += ", given up after %s attempts - contact the GEL helpdesk" % queue.max_attempts
+		print self.error
+
+	def read_and_parse(self):
+		'''Read the API and parse the json to create the report. Returns True if a pdf was created'''
+		# Call the function to read the API
+		with self.timer.stage("read_API_page"):
 			json = self.read_API_page()
-			# if test passed parse the json to pull out report
-			self.parse_json(json)
-	
+		# if test passed parse the json to pull out report
+		return self.parse_json(json)
+
 	def read_API_page(self):
 		'''
 		This function uses the authentication token to read the interpretation request list end point
@@ -114,26 +266,70 @@ class connect():
 		# use requests module to return all the cases available to you
 		
 		# insert CIP and proband into url
-		self.interpretationlist = self.interpretationlist.format(cip = config.CIP, proband = self.proband_id)
-		# if proxy is set in the config file
-		if config.proxy:
-			response = requests.get(self.interpretationlist, headers = {"Authorization": "JWT " + self.token}, proxies = config.proxy) # note space is required after JWT 
-		else:
-			response = requests.get(self.interpretationlist, headers = {"Authorization": "JWT " + self.token}) # note space is required after JWT 
+		interpretationlist = self.interpretationlist.format(cip = config.CIP, proband = self.proband_id)
+		response = self.api_get(interpretationlist)
+		# transient failures have already been retried (see request_policy.py), so stop if the request still failed
+		if response.status_code != 200:
+			raise ValueError("Received status: %s for url: %s with response: %s" % (response.status_code, interpretationlist, response.content))
 		# pass this in the json format to the parse_json function
 		return response.json()
 		
+
+	def api_get(self, url, headers=None):
+		'''GET a CIP-API url using the shared session (which applies the proxy from the config file).
+		If the token has been rejected (401), eg it has expired, a new token is requested and the request is tried once more'''
+		headers = dict(headers or {})
+		headers["Authorization"] = "JWT " + self.token # note space is required after JWT 
+		response = http_session.get(url, headers = headers)
+		if response.status_code == 401:
+			self.token = APIAuthentication().refresh_token(self.token)
+			headers["Authorization"] = "JWT " + self.token
+			response = http_session.get(url, headers = headers)
+		return response
+
+	def download_report(self, report_url):
+		'''Return the html of the clinical report, using the local report cache if it is set up in the config file'''
+		cache = report_cache.get_cache()
+		if cache:
+			return cache.fetch(report_url, self.api_get, report_cache.without_errors)
+		response = self.api_get(report_url)
+		if response.status_code != 200:
+			raise ValueError("Received status: %s for url: %s with response: %s" % (response.status_code, report_url, response.content))
+		return response.content
 			
 	def parse_json(self,json):
 		'''
 		This function takes the json file containing all cases whcih match the CIP, status and proband filter. 
 		A few checks are performed to ensure there is only one record before the record is parsed and the report is downloaded and modified
-		'''	
+		Returns True if the pdf was created
+		The work is split into fetch_report (network and LIMS), modify_report (parsing, CPU bound) and save_report (rendering), so in batch mode these can be run as separate stages (see pipeline.py)
+		'''
+		# read the report and patient information
+		if not self.fetch_report(json):
+			return False
+		
+		# the pdf doesn't need creating again if its inputs haven't changed since the last sync
+		if not self.unchanged:
+			# modify the report
+			html = self.modify_report(self.report, self.patient_info_dict)
+			# create the pdf
+			self.save_report(html)
+		return True
+
+	def fetch_report(self, json):
+		'''
+		Checks there is only one record in the json then downloads the report (self.report) and reads the patient information from the LIMS (self.patient_info_dict).
+		Returns True if the report is ready to be modified (or is unchanged since the last sync, see self.unchanged)
+		'''
 		# loop through the results
 		if json['count'] == 0:
-			print "no record for proband %s with the status sent_to_gmcs,report_generated or report_sent" % (self.proband_id)
+			self.error = "no record for proband %s with the status sent_to_gmcs,report_generated or report_sent" % (self.proband_id)
+			print self.error
+			return False
 		elif json['count'] > 1:
-			print "STOP - multiple unblocked interpretation requests for desired CIP (%s) found for proband %s\nPlease inform GEL" % (config.CIP, self.proband_id)
+			self.error = "STOP - multiple unblocked interpretation requests for desired CIP (%s) found for proband %s\nPlease inform GEL" % (config.CIP, self.proband_id)
+			print self.error
+			return False
 		else:
 			for sample in json['results']:
 				# ensure have found the desired proband id and make sure correct CIP
@@ -160,169 +356,167 @@ class connect():
 					if int(sample["interpreted_genomes"][interpreted_genome]["cip_version"]) > self.max_cip_ver:
 						self.max_cip_ver = sample["interpreted_genomes"][interpreted_genome]["cip_version"]
 				
+				# reading the interpretation request, the LIMS lookup and the report download don't depend on each other,
+				# so the interpretation request and LIMS are read in the background while the report is downloaded
 				#read the interpretation_request to pull out any variants
-				self.read_interpretation_request(sample)
-
-				# if proxy is set in the config file
-				if config.proxy:
-					report = requests.get(highest_report_url, headers = {"Authorization": "JWT " + self.token}, proxies = config.proxy)# note space is required after JWT 
-				else:
-					report = requests.get(highest_report_url, headers = {"Authorization": "JWT " + self.token})# note space is required after JWT 
-
-				# create an beautiful soup object for the html clinical report
-				soup = BeautifulSoup(report.content, "html.parser")
+				interpretation_request = background_call(self.read_interpretation_request, sample)
 				
-				#check for errors first
-				soup = self.check_for_errors(soup)
+				# with fail_fast_on_error_panel the LIMS isn't queried until the report is known not to have an error panel
+				fail_fast = getattr(config, "fail_fast_on_error_panel", False)
 				
-				# if headers are to be removed (not a negative negative)
-				if self.remove_headers == "True":
-					
-					#pass the object to the replace_gel_address function and update the object
-					soup = self.replace_gel_address(soup)
-
-					#read and remove the over header (grey bar with proband id and date generated)
-					soup = self.remove_over_header(soup)
-													
-					#pass to function to remove the banner text
-					soup = self.remove_banner_text(soup)
-					
-					#pass to function to put things from the over header into a different table
-					soup = self.move_date_report_generated(soup)
-					
-					
-				#pass to function to replace the GeL logo with that of the lab (and or UKAS)
-				soup = self.replace_GeL_logo(soup)
+				## Call function to pull out patient demographics from LIMS. capture dict
+				if not fail_fast:
+					lims_lookup = background_call(self.timer.call, "read_lims", self.read_lims, sample["sites"])
 				
-				#stop the annex tables being split over pages
-				soup = self.stop_annex_tables_splitting_over_page(soup)
+				# download the report (or take it from the report cache)
+				with self.timer.stage("download_report"):
+					report = self.download_report(highest_report_url)
 				
-				# pass to function to expand coverage
-				soup = self.expand_coverage(soup)
-											
-				#write html to file so can be read in edit_CSS function
-				with open(self.html_report, "w") as file:
-					file.write(str(soup))
-
-				## Call function to pull out patient demographics from LIMS. capture dict
-				patient_info_dict = self.read_lims(sample["sites"])
+				# if the report contains an error panel and fail_fast_on_error_panel is set, stop before the LIMS lookup and the expensive parsing and rendering.
+				# A plain text search is enough to find the error panel without parsing the report
+				if fail_fast:
+					if report_cache.has_error_panel(report):
+						self.queue_retry("report for proband %s contains an error panel" % self.proband_id)
+						return False
+					queue = retry_queue.get_queue()
+					if queue:
+						queue.remove(self.proband_id)
+					lims_lookup = background_call(self.timer.call, "read_lims", self.read_lims, sample["sites"])
+				
+				# wait for the interpretation request and LIMS lookup to finish
+				interpretation_request.result()
+				patient_info_dict = lims_lookup.result()
 				
-				#Can't change CSS or insert tables using beautiful soup so need to read and replace html file
-				self.edit_CSS(patient_info_dict)
+				self.report = report
+				self.patient_info_dict = patient_info_dict
 				
-				print "creating clinical report"
+				if self.work_queue:
+					self.work_queue.update(self.proband_id, work_queue.FETCHED)
 				
-				#pass modified file to create a pdf.
-				self.create_pdf(self.htmlfilename, self.pdf_report, patient_info_dict)
+				# when syncing, skip the report if the existing pdf was created from the same inputs
+				if self.sync_state:
+					self.sync_inputs = sync_state.report_inputs(sample["interpretation_request_id"], highest_report_version, self.max_cip_ver, report, patient_info_dict, self.remove_headers)
+					if self.sync_state.unchanged(self.proband_id, self.sync_inputs, self.pdf_report):
+						self.unchanged = True
+						print "report unchanged since last sync"
 
+			return True
+
+	def save_report(self, html):
+		'''Create the pdf from the modified report html'''
+		# if required keep a copy of the html (for debugging)
+		if config.write_intermediate_html:
+			with open(self.html_report, "w") as file:
+				file.write(html)
+		
+		print "creating clinical report"
+		
+		#pass modified html to create a pdf.
+		self.create_pdf(html, self.pdf_report)
+		
+		# record the inputs used so the pdf isn't created again until they change
+		if self.sync_state:
+			self.sync_state.record(self.proband_id, self.sync_inputs, self.pdf_report)
 
 					
-	def edit_CSS(self,patient_info_dict):
-		'''Can't change CSS or insert tables using beautiful soup so need to read and replace html file.
-		This function reads that file, loops through it and 
+	def modify_report(self, report, patient_info_dict):
+		'''Make all the modifications to the downloaded report and return the html, ready to be rendered'''
+		# create an beautiful soup object for the html clinical report, using the parser set in the config file (see default_html_parser)
+		with self.timer.stage("parse"):
+			soup = BeautifulSoup(report, self.html_parser)
+		
+		# make all the modifications to the report in a single pass through the html (see report_rules). Each modification is timed separately
+		soup = self.report_rules().apply(soup, self.timer)
+		
+		with self.timer.stage("serialise"):
+			html = str(soup)
+		
+		#Can't change CSS or insert tables using beautiful soup so edit the html as text (all in memory)
+		with self.timer.stage("edit_CSS"):
+			return self.edit_CSS(html, patient_info_dict)
+
+	def edit_CSS(self, html, patient_info_dict):
+		'''Can't change CSS or insert tables using beautiful soup so need to edit the html as text.
+		This function takes the html (from beautiful soup), replaces the lines containing each insertion point and returns the modified html.
 		1 - Adds in a table containing patient information extracted from LIMS
 		
 		for reports that are being modified to look like they are not from gel:
 			2 - edits the CSS which defines the banner colour so it is transparent
 			3 - Adds the date report generated to the table (was previously in the grey header)
 			4 - Adds in table with clinician referral information			
+		The tables are Jinja templates, which are populated with the patient information (from LIMS) before they are added.
+		Only the templates go through Jinja, not the whole report.
 		'''
-		# read file into object (a list) 
-		with open(self.html_report, "r") as file:
-			data = file.readlines()
-			#loop through the file object
-			for i, line in enumerate(data):
-				## Add in the new patient info table
-				# if the line is where we want to add in this table (defined in __init__)
-				if self.where_to_put_patient_info_table in line:
-					# open the html template
-					with open(config.new_patientinfo_table,"r") as template:
-						#write template to a list
-						template_to_write = template.readlines()
-						# Add in this template at this position NB this will over write the line so this line is also in the template
-						data[i] = "".join(template_to_write)
-				
-				# if it's a report which is to be modified
-				if self.remove_headers == "True":
-					## Replace the banner CSS
-					# if line contains the existing banner css (from __init__)
-					if self.existing_banner_css in line:
-						# replace that line in the file object so it's now transparent background
-						data[i]=line.replace(self.existing_banner_css, self.new_banner_css)
-				
-					## Add extra row to the table with the date report generated
-					# if the last row of the table (as stated in the function move_date_report_generated)
-					if self.lastrow in line:
-						# create empty list
-						template_to_write = []
-						# write the table code to the list
-						template_to_write.append("<tr><td>Date Report Generated:</td><td><em>" + self.date_generated + "</em></td></tr>")
-						# append the last row as below we are overwriting the existing line
-						template_to_write.append(self.lastrow)
-						# Add this list to the file object
-						data[i] = "".join(template_to_write)
-					
-					## Add in the clinician and address
-					# look for desired location
-					if self.where_to_put_clinician_info in line:
-						#empty list
-						template_to_write = []
-						#add new div
-						#template_to_write.append("<div>")
-						# add line which is going to be replaced
-						template_to_write.append(self.where_to_put_clinician_info)
-						
-						# open html template containing the clinician info structure (and a new header)
-						with open(config.new_clinician_table,"r") as template:
-							# add this file to the list
-							for line in template.readlines():
-								#print patient_info_dict['clinician1']									
-								if line.startswith("<p>cc.{{copies}}</p>"):
-									if patient_info_dict['copies'] == "":
-										pass
-									else:
-										template_to_write.append(line)
-								else:
-									template_to_write.append(line)
-								
-						# add the new html code back to the list
-						data[i] = "".join(template_to_write)
-				
-				# otherwise add in clinician info for less heavily modified reports
-				else:		
-					## Add in the clinician and address
-					# look for desired location
-					if gel_logo.gel_logo_code in line:
-						#empty list
-						template_to_write = []
-						# add line which is going to be replaced
-						template_to_write.append(gel_logo.gel_logo_code)
-						
-						# open html template containing the clinician info structure (and a new header)
-						with open(config.new_clinician_table,"r") as template:
-							# add this file to the list
-							for line in template.readlines():
-								#print patient_info_dict['clinician1']									
-								if line.startswith("<p>cc.{{copies}}</p>"):
-									if patient_info_dict['copies'] == "":
-										pass
-									else:
-										template_to_write.append(line)
-								else:
-									template_to_write.append(line)
-										
-						# add the new html code back to the list
-						data[i] = "".join(template_to_write)
-
-			#write the modified list back to a file
-			with open(self.html_report, "w") as file:
-				file.writelines(data)
+		# populate the templates (compiled once and cached, see load_template)
+		with self.timer.stage("jinja_render"):
+			patient_info_table = render_template(config.new_patientinfo_table, patient_info_dict)
+			# the cc line is left out if there are no copies
+			clinician_table = render_template(config.new_clinician_table, patient_info_dict, without_copies=patient_info_dict['copies'] == "")
+		
+		# split the html into a list of lines (the same as reading it from a file with readlines)
+		data = StringIO(html).readlines()
+		
+		# the position in the html where each line starts, used to find the line containing each insertion point
+		line_starts = []
+		position = 0
+		for line in data:
+			line_starts.append(position)
+			position += len(line)
+		
+		# the lines to change are found by searching the whole html once for each insertion point, rather than checking every line for each one.
+		# Each entry is (insertion point, function returning the new line); where one line has more than one insertion point the last one is used
+		changes = [
+			## Add in the new patient info table (where defined in __init__). NB this will over write the line so this line is also in the template
+			(self.where_to_put_patient_info_table, lambda line: patient_info_table)]
+		
+		# if it's a report which is to be modified
+		if self.remove_headers == "True":
+			changes += [
+				## Replace the banner CSS (from __init__) so it's now a transparent background
+				(self.existing_banner_css, lambda line: line.replace(self.existing_banner_css, self.new_banner_css)),
+				## Add extra row to the table with the date report generated, above the last row of the table (as stated in the function move_date_report_generated)
+				(self.lastrow, lambda line: "<tr><td>Date Report Generated:</td><td><em>" + self.date_generated.encode("utf-8") + "</em></td></tr>" + self.lastrow),
+				## Add in the clinician and address (and a new header) after the new logo
+				(self.where_to_put_clinician_info, lambda line: self.where_to_put_clinician_info + clinician_table)]
+		# otherwise add in clinician info for less heavily modified reports
+		else:
+			## Add in the clinician and address (and a new header) after the GeL logo
+			changes.append((gel_logo.gel_logo_code, lambda line: gel_logo.gel_logo_code + clinician_table))
+		
+		new_lines = {}
+		for insertion_point, new_line in changes:
+			for i in self.find_lines(html, line_starts, insertion_point):
+				new_lines[i] = new_line(data[i])
+		
+		for i, line in new_lines.items():
+			data[i] = line
+
+		#return the modified html
+		return "".join(data)
+	
+	def find_lines(self, html, line_starts, text):
+		'''Returns the index of each line of the html which contains the text. line_starts is the position in the html where each line starts.
+		Only matches within a single line are returned (as when checking each line in turn). An empty string (eg an insertion point which wasn't found in the report) matches nothing'''
+		lines = []
+		if not text:
+			return lines
+		position = html.find(text)
+		while position != -1:
+			i = bisect.bisect_right(line_starts, position) - 1
+			# check the match doesn't run on to the next line
+			if i + 1 == len(line_starts) or position + len(text) <= line_starts[i + 1]:
+				if not lines or lines[-1] != i:
+					lines.append(i)
+			position = html.find(text, position + 1)
+		return lines
 	
 
 	def read_lims(self, sites):
 		'''This function must create a dictionary which is used to populate the html variables 
 		eg patient_info_dict={"NHS":NHS,"InternalPatientID":InternalPatientID,"dob":DOB,"firstname":FName,"lastname":LName,"Sex":Sex,"clinician1":clinician1,"clinician1_add":clinician1_address,"copies":copies,"report_title":report_title}
-		NB report_title is from the config file'''
+		NB report_title is from the config file
+		In batch mode the LIMS record for the proband may already have been fetched by a single bulk query for the whole batch (lims_bulk_query in the config file, see lims.bulk_lookup).
+		If so self.lims_record is a dictionary of column name: value (or None if the proband wasn't found), which can be used instead of querying the LIMS again'''
 		
 		# TO BE COMPLETED BY EACH GMC
 		if find_patient:
@@ -333,186 +527,180 @@ class connect():
 			return patient_info_dict
 		else:
 			# report error and quit if can't find all the required info (or if it doesn't meet required formats)
+			self.error = "No Patient information for that proband in database"
 			print "No Patient information for that proband in database\ncannot create report"
 			quit()
 		
 	
 	
-	def check_for_errors(self, html):
-		'''issue warning (or abort) if any errors are found when reporting eg can't find coverage report etc. Uses a warning message from config file'''
-		# look for presence of an warning message
-		for div in html.find_all('div', {'class':'content-div error-panel'}):
-			# if there is an error
-			if div:
-				# capture and print the error message
-				for message in div.find_all('p'):
-					print (config.warning_message % self.proband_id) + message.get_text()
-				
-				#if required stop the report being generated
-				#quit()
-				
-		# return html
-		return html
+	def report_rules(self):
+		'''Returns the modifications to make to the report as rules for the rewrite engine (see dom_rewrite.py), which applies them all in a single pass through the html.
+		Each rule is a tag name, the attributes the tag must have and the function to call with each matching tag'''
+		rules = dom_rewrite.RewriteEngine()
+		
+		#check for errors first
+		rules.add_rule('div', self.check_for_errors, {'class':'content-div error-panel'})
+		
+		# if headers are to be removed (not a negative negative)
+		if self.remove_headers == "True":
+			#remove the gel address
+			rules.add_rule('p', self.replace_gel_address, {'class':'note'})
 			
-	def replace_gel_address(self,html):
-		'''This function looks for and removes the GeL address '''
-		# notes is a list of all the p tags where the class == note
-		for note in html.find_all('p', {'class':'note'}):
-			# if text == gel address (as defined in the init function)
-			if self.old_header in note.get_text():
-				# remove the gel address tag
-				note.extract()
-		# return modified html
-		return html
-	
-	def move_date_report_generated(self,html):
-		'''This function looks for the table underneath the GEl address and above participant info and puts in the information from the over_header'''
-		#loop through the tables - the table we are after is the only one with class=form-table and cellpadding=0
-		for table in html.find_all('table', {'class':'form-table', 'cellpadding':'0'}):
-			# find all rows in the table
-			rows=table.find_all('tr')
-			#loop through rows
-			for row in rows:
-				#find all columns
-				cols=row.find_all('td')
-				# loop through columns
-				for col in cols:
-					# if the column contains "Link to clinical summary"
-					if self.replace_with_proband_id in col.get_text():
-						# replace the string with GEL Proband ID (defined in init)
-						col.string=col.get_text().replace(self.replace_with_proband_id,self.proband_id_string)
-					# remove the <a> tag around the GeL ID and remove the hyperlink (link won't work without logging in first)
-					for a in col.find_all('a'):
-						a.replaceWithChildren()
-						#delete hyperlink
-						del a['href']
-			#capture the last row of the table to use to insert another row to the table elsewhere in the script
-			self.lastrow=str(row)
+			#read and remove the over header (grey bar with proband id and date generated)
+			rules.add_rule('span', self.read_date_report_generated, {'class':'right'})
+			rules.add_rule('div', self.remove_over_header, {'class':'over-header content-div'})
 			
-		#return new html							
-		return html
+			#remove the banner text
+			rules.add_rule('div', self.remove_banner_text, {'class':'banner-text'})
+			
+			#put things from the over header into a different table
+			rules.add_rule('table', self.move_date_report_generated, {'class':'form-table', 'cellpadding':'0'})
+			rules.add_finaliser(self.capture_last_row)
+		
+		#replace the GeL logo with that of the lab (and or UKAS)
+		rules.add_rule('img', self.replace_GeL_logo, {'class':"logo"})
+		
+		#stop the annex tables being split over pages
+		rules.add_rule('th', self.stop_annex_tables_splitting_over_page)
+		
+		#expand coverage
+		rules.add_rule('div', self.expand_coverage, {'id':"coverage"})
+		rules.add_rule('a', self.expand_coverage_header)
+		
+		return rules
 	
-	def remove_over_header(self,html):
-		'''This function reads and then removes the grey bar at the top of the report containing the proband id and the date report was generated'''
-		# find the span tag where class=right (should only be one - the date generated)
-		for span in html.find_all('span', {'class':'right'}):
-				# capture the text, and remove the Generated on string
-				self.date_generated=span.get_text().replace('Generated on:','')
+	def check_for_errors(self, div):
+		'''issue warning (or abort) if any errors are found when reporting eg can't find coverage report etc. Uses a warning message from config file.
+		Called for each div with the class content-div error-panel'''
+		# capture and print the error message
+		for message in div.find_all('p'):
+			print "proband %s: %s%s" % (self.proband_id, config.warning_message, message.get_text())
 		
+		#if required stop the report being generated
+		#quit()
+			
+	def replace_gel_address(self, note):
+		'''This function looks for and removes the GeL address. Called for each p tag where the class == note'''
+		# if text == gel address (as defined in the init function)
+		if self.old_header in note.get_text():
+			# remove the gel address tag
+			return dom_rewrite.REMOVE
+	
+	def move_date_report_generated(self, table):
+		'''This function looks for the table underneath the GEl address and above participant info and puts in the information from the over_header.
+		Called for each table with class=form-table and cellpadding=0 (the table we are after is the only one)'''
+		# find all rows in the table
+		rows=table.find_all('tr')
+		#loop through rows
+		for row in rows:
+			#find all columns
+			cols=row.find_all('td')
+			# loop through columns
+			for col in cols:
+				# if the column contains "Link to clinical summary"
+				if self.replace_with_proband_id in col.get_text():
+					# replace the string with GEL Proband ID (defined in init)
+					col.string=col.get_text().replace(self.replace_with_proband_id,self.proband_id_string)
+				# remove the <a> tag around the GeL ID and remove the hyperlink (link won't work without logging in first)
+				for a in col.find_all('a'):
+					a.replaceWithChildren()
+					#delete hyperlink
+					del a['href']
+		#capture the last row of the table to use to insert another row to the table elsewhere in the script (converted to html by capture_last_row)
+		if rows:
+			self.lastrow = row
+	
+	def capture_last_row(self):
+		'''Convert the last row of the table found by move_date_report_generated to html, once all modifications have been made'''
+		if self.lastrow:
+			self.lastrow = str(self.lastrow)
+	
+	def read_date_report_generated(self, span):
+		'''This function reads the date the report was generated from the grey bar at the top of the report. Called for the span tag where class=right (should only be one - the date generated)'''
+		# capture the text, and remove the Generated on string
+		self.date_generated=span.get_text().replace('Generated on:','')
+	
+	def remove_over_header(self, div):
+		'''This function removes the grey bar at the top of the report containing the proband id and the date report was generated'''
 		#delete the div containing the over header 
-		for div in html.find_all('div', {'class':'over-header content-div'}):
-			div.decompose()
-		#return new html
-		return html
+		return dom_rewrite.REMOVE
 	
-	def remove_banner_text(self,html):
+	def remove_banner_text(self, div):
 		'''This function removes the title from the big green banner (Whole Genome Analysis Rare disease Primary Findings)'''
 		# remove the header text
-		for div in html.find_all('div', {'class':'banner-text'}):
-			div.decompose()
-		#return new html
-		return html
+		return dom_rewrite.REMOVE
 	
-	def stop_annex_tables_splitting_over_page(self,html):
-		'''This script takes the referenced databases and software version tables and stops these being broken over pages'''
-		
-		# find all tables
-		for table in html.find_all('table'):
+	def stop_annex_tables_splitting_over_page(self, col):
+		'''This script takes the referenced databases and software version tables and stops these being broken over pages.
+		Called for each column in a table header'''
+		# if there is a column called name 
+		if col.get_text() == "Name":
 			#find the table head
-			for head in table.find_all('thead'):
-				# find each column in the header
-				for col in head.find_all('th'):
-					# if there is a column called name 
-					if col.get_text() == "Name":
-						# prevent page breaks
-						table['style'] = " page-break-inside: avoid !important"
-		#return new html		
-		return html
-		
-	def replace_GeL_logo(self,html):
-		'''This function replaces gel logo with a new logo'''
+			head = col.find_parent('thead')
+			if head:
+				# prevent page breaks in the table (and any table it is within)
+				for table in head.find_parents('table'):
+					table['style'] = " page-break-inside: avoid !important"
+		
+	def replace_GeL_logo(self, img):
+		'''This function replaces gel logo with a new logo. Called for the img tag where class == logo (should only be one)'''
 		if self.remove_headers == "True":
-			# find the img tag where class == logo (should only be one)
-			for img in html.find_all('img', {'class':"logo"}):
-				# change the src to link to new image
-				img['src'] = config.new_logo
-				#change the style so is on right hand side and has a small margin
-				img['style'] = "float:right; margin: 2%;"
-				
-				# capture this tag so we can use it to place the clinicians name and address
-				self.where_to_put_clinician_info = str(img)
+			# change the src to link to new image
+			img['src'] = config.new_logo
+			#change the style so is on right hand side and has a small margin
+			img['style'] = "float:right; margin: 2%;"
+			
+			# capture this tag so we can use it to place the clinicians name and address
+			self.where_to_put_clinician_info = str(img)
 		else:
-			# find the img tag where class == logo (should only be one)
-			for img in html.find_all('img', {'class':"logo"}):
-				# Need to ensure the image doesn't shrink
-				img['style'] = "height:100px;"
-		
-		# return the modified html
-		return html
+			# Need to ensure the image doesn't shrink
+			img['style'] = "height:100px;"
 	
-	def expand_coverage(self,html):
-		'''Expand the coverage section'''
-		# find the coverage div and delete so coverage seciton no longer needs to be clicked to be visible
-		for section in html.find_all('div', id = "coverage"):
-			del(section['hidden'])
-
-		# find the section header and remove text/hyperlink properties
-		for section in html.find_all('a'):
-			# find the coverage section
-			if "Coverage Metrics" in section.get_text():
-				# remove the extra styles no longer needed
-				del(section['onclick'])
-				del(section['style'])
-				# create new tag and section title
-				new_header = "Coverage Report"
-				# replace p with h3
-				section.name = "h3"
-				# change the string
-				section.string = new_header
-		return html
-
-
-	def create_pdf(self, htmlfilename, pdfreport_path, patient_info):
-		# add the path to wkhtmltopdf to the pdfkit config settings
-		pdfkitconfig = pdfkit.configuration(wkhtmltopdf=config.wkhtmltopdf_path)
+	def expand_coverage(self, section):
+		'''Expand the coverage section. Called for the div with id == coverage'''
+		# delete hidden so coverage seciton no longer needs to be clicked to be visible
+		del(section['hidden'])
+
+	def expand_coverage_header(self, section):
+		'''Remove the text/hyperlink properties from the coverage section header. Called for each a tag'''
+		# find the coverage section
+		if "Coverage Metrics" in section.get_text():
+			# remove the extra styles no longer needed
+			del(section['onclick'])
+			del(section['style'])
+			# create new tag and section title
+			new_header = "Coverage Report"
+			# replace p with h3
+			section.name = "h3"
+			# change the string
+			section.string = new_header
+
+	def create_pdf(self, html, pdfreport_path):
+		'''Render the modified report (with the patient information already added, see edit_CSS) to a pdf'''
 		# create options to use in the footer
 		options = {'footer-right':'Page [page] of [toPage]','footer-left':'Date Created [isodate]','quiet':""}
-				
-		# use Jinja to populate the variables within the html template
-		# first tell the system where to find the html template (this is written by beautiful soup above)
-		env = Environment(loader=FileSystemLoader(config.html_reports))
-		template = env.get_template(htmlfilename)
 		
-		# create the pdf using template.render to populate variables from dictionary created in read_geneworks
-		pdfkit.from_string(template.render(patient_info), pdfreport_path, options=options, configuration=pdfkitconfig)
+		# the render is queued to the pool of wkhtmltopdf workers (see pdf_render.py) which uses the path to wkhtmltopdf from the config file
+		with self.timer.stage("wkhtmltopdf"):
+			pdf_render.get_pool().render(html, pdfreport_path, options)
 		
 		# print 
 		print "Report can be found at "+pdfreport_path
 		
-	def fetchone(self, query):
-		# Connection
-		cnxn = pyodbc.connect(dbconnectstring)
-		# Opening a cursor
-		cursor = cnxn.cursor()
+	def fetchone(self, query, params=None):
+		'''Run a query on the LIMS and return the first row. Connections are pooled and reused (see lims.py). Use ? in the query for parameters'''
 		#perform query
-		cursor.execute(query)
-		#capture result
-		result = cursor.fetchone()
+		result = lims.fetchone(query, params)
 		#yield result
 		if result:
 			return result
 		else:
 			print "no result found"
 	
-	def fetchall(self, query):
-		# Connection
-		cnxn = pyodbc.connect(dbconnectstring)
-		# Opening a cursor
-		cursor = cnxn.cursor()
+	def fetchall(self, query, params=None):
+		'''Run a query on the LIMS and return all rows. Connections are pooled and reused (see lims.py). Use ? in the query for parameters'''
 		#perform query
-		cursor.execute(query)
-		#capture result
-		result = cursor.fetchall()
+		result = lims.fetchall(query, params)
 		#yield result
 		if result:
 			return(result)
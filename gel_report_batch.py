@@ -0,0 +1,295 @@
+'''
+gel_report_batch.py
+This script takes a list of GEL Participant IDs (from a file or stdin) and creates a clinical report for each, using gel_report.py.
+Alternatively (-a) reports are created for every proband with a case for the CIP (in the config file) which is ready to be reported. The cases are read from the API a page at a time while the reports are being created.
+Or (-r) reports which had an error panel are tried again, once their wait in the retry queue (see retry_queue.py) is over.
+
+If work_queue_db is set in the config file the state of each report is recorded in a work queue (see work_queue.py), so an interrupted batch can be continued with --resume.
+With --resume, the probands given whose reports the queue records as finished (rendered or failed) aren't created again.
+Reports are taken from the queue highest priority first (-u), whichever batch added them, so urgent requests run as a second batch are also picked up by a large batch which is already running.
+
+A single API token is shared by all reports, and the reports are created by a bounded pool of workers so several are generated at once.
+If batch_pipeline is set in the config file the work is split into stages (downloading, modifying in separate processes, and rendering), each with its own workers (see pipeline.py).
+A summary of which reports succeeded or failed is written at the end.
+'''
+import sys
+import getopt
+import itertools
+from multiprocessing.pool import ThreadPool
+
+# Import local settings
+from authentication import APIAuthentication # import the function from the authentication script which generates the access token
+import gel_report_config as config # config file
+from gel_report import connect
+from cipapi_client import ConcurrentCIPAPIClient
+import lims
+import retry_queue
+import work_queue
+from pipeline import ReportPipeline, start_transform_pool
+
+
+class batch():
+	def __init__(self):
+		# Usage example
+		self.usage = "python gel_report_batch.py -f <file of GELParticipantIDs, or - for stdin> | -a | -r -h True/False [--resume] [-u <priority>] [-w <workers>] [-s <summary file>] [-p cprofile]"
+
+		# file containing the proband IDs (one per line). "-" reads from stdin
+		self.proband_file = ""
+
+		# create reports for every proband with a case ready to be reported, rather than those in a file
+		self.all_cases = False
+
+		# create reports for the probands in the retry queue which are due to be tried again
+		self.retries = False
+
+		# create the unfinished reports from earlier batches (in the work queue)
+		self.resume = False
+
+		# priority of the reports in this batch in the work queue. Higher priorities are created first
+		self.priority = 0
+
+		# flag passed on to each report (see gel_report.py)
+		self.remove_headers = ""
+
+		# number of reports to generate at once
+		self.workers = config.batch_workers
+
+		# optional file to write the per-proband summary to
+		self.summary_file = ""
+
+		# profile each report (see timing.profilers); the results are written next to each pdf
+		self.profile = ""
+
+		# the api token shared by all reports
+		self.token = ""
+
+		# LIMS records for the batch, by proband ID (if lims_bulk_query is set in the config file)
+		self.lims_records = None
+
+		# record of the inputs each pdf was created from (set when syncing, see gel_report_sync.py)
+		self.sync_state = None
+
+		# the state of each report in the batch (if work_queue_db is set in the config file)
+		self.work_queue = None
+
+	def take_inputs(self, argv):
+		'''Capture the proband list and settings from the command line'''
+		# define expected inputs
+		try:
+			opts, args = getopt.getopt(argv, "arf:h:u:w:s:p:", ['all', 'retry', 'file=', 'removeheader=', 'priority=', 'resume', 'workers=', 'summary=', 'profile='])
+		# raise errors with usage eg
+		except getopt.GetoptError:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		# loop through the arguments
+		for opt, arg in opts:
+			if opt in ("-a", "--all"):
+				self.all_cases = True
+			if opt in ("-r", "--retry"):
+				self.retries = True
+			if opt in ("-f", "--file"):
+				self.proband_file = str(arg)
+			if opt in ("-h", "--removeheader"):
+				self.remove_headers = str(arg)
+			if opt in ("-u", "--priority"):
+				self.priority = int(arg)
+			if opt == "--resume":
+				self.resume = True
+			if opt in ("-w", "--workers"):
+				self.workers = int(arg)
+			if opt in ("-s", "--summary"):
+				self.summary_file = str(arg)
+			if opt in ("-p", "--profile"):
+				self.profile = str(arg)
+
+		if not self.proband_file and not self.all_cases and not self.retries and not self.resume:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		# the pipeline's transform processes are started before anything starts a thread, as forking a process with running threads isn't safe
+		if self.use_pipeline():
+			start_transform_pool()
+
+		self.work_queue = work_queue.get_queue()
+		if self.resume and not self.work_queue:
+			print "ERROR - work_queue_db is not set in the config file"
+			sys.exit(2)
+
+		# authenticate once for the whole batch
+		self.token = APIAuthentication().token
+
+		# read the proband list (or the cases from the API) and create the reports
+		if self.all_cases:
+			proband_ids = ConcurrentCIPAPIClient(self.token).sweep_probands()
+		elif self.retries:
+			proband_ids = self.read_retries()
+		elif self.proband_file:
+			proband_ids = self.read_proband_ids()
+		else:
+			proband_ids = []
+
+		if self.resume:
+			print "%s unfinished reports resumed" % self.work_queue.resume()
+		results = self.run(proband_ids)
+		self.write_summary(results)
+
+	def read_proband_ids(self):
+		'''Read the proband IDs, one per line. Blank lines, comments (#) and duplicates are ignored'''
+		if self.proband_file == "-":
+			lines = sys.stdin.readlines()
+		else:
+			with open(self.proband_file, "r") as file:
+				lines = file.readlines()
+
+		proband_ids = []
+		for line in lines:
+			proband_id = line.strip()
+			if proband_id and not proband_id.startswith("#") and proband_id not in proband_ids:
+				proband_ids.append(proband_id)
+		return proband_ids
+
+	def read_retries(self):
+		'''The probands in the retry queue which are due to be tried again'''
+		queue = retry_queue.get_queue()
+		if not queue:
+			print "ERROR - retry_queue_db is not set in the config file"
+			sys.exit(2)
+		for proband_id, attempts, error in queue.given_up():
+			print "%s has been given up on after %s attempts: %s" % (proband_id, attempts, error)
+		return queue.due()
+
+	def run(self, proband_ids):
+		'''Create reports for all proband IDs (a list or a generator) using a pool of workers. Returns a list of (proband_id, status, message) tuples in input order'''
+		# authenticate once for the whole batch
+		if not self.token:
+			self.token = APIAuthentication().token
+
+		# fetch the LIMS records for the batch with one query per chunk of probands, if the query is set in the config file.
+		# This is done before the probands are added to the work queue, so a generator (eg the cases read from the API) is still read a chunk at a time
+		if getattr(config, "lims_bulk_query", None):
+			self.lims_records = {}
+			proband_ids = self.prefetch_lims(proband_ids)
+
+		# take the reports from the work queue, highest priority first. A list is written to the queue before any work starts, so if the batch is interrupted --resume creates the rest
+		if self.work_queue:
+			if isinstance(proband_ids, list):
+				finished = self.work_queue.add_many(proband_ids, self.priority, self.resume)
+				if finished:
+					print "%s reports had already finished and won't be created again" % len(finished)
+				proband_ids = []
+			proband_ids = self.work_queue.probands(proband_ids, self.priority, self.resume)
+
+		if self.use_pipeline():
+			pipeline = ReportPipeline(self.new_connect,
+				fetch_workers=max(1, self.workers),
+				render_workers=getattr(config, "render_workers", None),
+				queue_size=getattr(config, "pipeline_queue_size", None),
+				transform_timeout=getattr(config, "pipeline_transform_timeout", None))
+			completed = pipeline.run(proband_ids)
+			pool = None
+		else:
+			pool = ThreadPool(max(1, self.workers))
+			completed = pool.imap_unordered(self.run_proband, enumerate(proband_ids))
+		try:
+			results = []
+			# report progress as each proband completes
+			for result in completed:
+				results.append(result)
+				print "%s %s %s" % (len(results), result[1], result[2])
+				if self.work_queue:
+					if result[2] == "FAILED":
+						self.work_queue.update(result[1], work_queue.FAILED, result[3])
+					else:
+						self.work_queue.update(result[1], work_queue.RENDERED)
+		finally:
+			if pool:
+				pool.close()
+				pool.join()
+			lims.close_pool()
+		# put the results back in input order and remove the index
+		return [result[1:] for result in sorted(results)]
+
+	def use_pipeline(self):
+		'''True if the reports are created by the pipeline (batch_pipeline in the config file). The pipeline can't profile reports as they are modified in separate processes'''
+		return getattr(config, "batch_pipeline", False) and not self.profile
+
+	def prefetch_lims(self, proband_ids):
+		'''Fetch the LIMS records for the proband IDs (see fetch_lims). A list is fetched straight away and returned; a generator is read a chunk of IDs at a time, fetching the records for each chunk before its IDs are passed on'''
+		if isinstance(proband_ids, list):
+			self.fetch_lims(proband_ids)
+			return proband_ids
+		return self.prefetch_lims_chunks(iter(proband_ids))
+
+	def prefetch_lims_chunks(self, proband_ids):
+		'''Generator fetching the LIMS records for each chunk of IDs read from proband_ids, then yielding the IDs'''
+		chunk_size = getattr(config, "lims_bulk_chunk_size", 1000)
+		while True:
+			chunk = list(itertools.islice(proband_ids, chunk_size))
+			if not chunk:
+				return
+			self.fetch_lims(chunk)
+			for proband_id in chunk:
+				yield proband_id
+
+	def fetch_lims(self, proband_ids):
+		'''Fetch the LIMS records for the proband IDs with one query per chunk (see lims.bulk_lookup), recording None for the probands which aren't in the LIMS'''
+		records = lims.bulk_lookup(proband_ids)
+		for proband_id in proband_ids:
+			self.lims_records[str(proband_id)] = records.get(str(proband_id))
+
+	def run_proband(self, indexed_proband_id):
+		'''Create the report for a single proband. Takes and returns the position of the proband in the input, so the results can be put back in order. Returns a tuple of (index, proband_id, status, message)'''
+		index, proband_id = indexed_proband_id
+		c = connect(self.token)
+		try:
+			self.set_up(c, proband_id)
+			if c.generate_report():
+				if c.unchanged:
+					return (index, proband_id, "UNCHANGED", c.pdf_report)
+				return (index, proband_id, "SUCCESS", c.pdf_report)
+			return (index, proband_id, "FAILED", c.error or "no report created")
+		# read_lims calls quit() if the patient can't be found so catch SystemExit as well, otherwise the worker is lost
+		except (Exception, SystemExit) as e:
+			return (index, proband_id, "FAILED", c.error or repr(e))
+
+	def set_up(self, c, proband_id):
+		'''Apply the batch settings to the connect object for a proband'''
+		c.remove_headers = self.remove_headers
+		c.profile = self.profile
+		c.set_proband(proband_id)
+		c.sync_state = self.sync_state
+		c.work_queue = self.work_queue
+		if self.lims_records is not None:
+			# probands added to the work queue by another batch haven't been fetched yet
+			if str(proband_id) not in self.lims_records:
+				self.fetch_lims([proband_id])
+			c.lims_record = self.lims_records.get(str(proband_id))
+
+	def new_connect(self, proband_id):
+		'''Returns a connect object set up to create the report for this proband (used by the pipeline)'''
+		c = connect(self.token)
+		self.set_up(c, proband_id)
+		return c
+
+	def write_summary(self, results):
+		'''Print a tab separated summary of the batch, and write it to the summary file if given'''
+		lines = ["\t".join([proband_id, status, message.replace("\n", " ")]) for proband_id, status, message in results]
+		failed = len([result for result in results if result[1] == "FAILED"])
+		unchanged = len([result for result in results if result[1] == "UNCHANGED"])
+
+		print "\n".join(lines)
+		if self.sync_state:
+			print "%s reports created, %s unchanged, %s failed" % (len(results) - failed - unchanged, unchanged, failed)
+		else:
+			print "%s reports created, %s failed" % (len(results) - failed, failed)
+
+		if self.summary_file:
+			with open(self.summary_file, "w") as file:
+				file.write("proband_id\tstatus\tmessage\n")
+				file.write("\n".join(lines) + "\n")
+
+
+if __name__=="__main__":
+	b=batch()
+	b.take_inputs(sys.argv[1:])
@@ -6,10 +6,53 @@ app_home="/home/mokaguys/Apps/CIP_API/" # note trailing slash!!
 username =  app_home + "auth_username.txt"
 pw = app_home + "auth_pw.txt"
 
+# file used to cache the API token between runs (and share it between processes). Comment out to only cache tokens in memory
+token_cache = app_home + "token_cache.json"
+# request a new token this many seconds before the cached token expires
+token_refresh_margin = 60
+
 ####################### Requests module ##################
 #the proxy settings for requests module
 proxy={'http':'proxy:80'} # if proxy is not required remove/comment this line do not leave blank
 
+# number of connections to keep open to the CIP-API (should be at least batch_workers)
+http_pool_size = 10
+
+# seconds to wait to connect to a host, and for each read of its response, before the request times out (and is retried). None to wait forever
+http_connect_timeout = 10
+http_read_timeout = 120
+# the most requests per second to each host (a token bucket, see request_policy.py). The rate is halved when the API replies 429 (too many requests). Leave as None for no limit
+http_rate_limit = 20
+# the most requests to a host at once after a quiet period (None = http_rate_limit)
+http_rate_burst = None
+# requests which fail with 429, 5xx or a connection error are tried again this many times, waiting a random time up to http_backoff seconds (doubling with each retry, up to http_max_backoff) or as long as the Retry-After header asks
+http_retries = 4
+http_backoff = 0.5
+http_max_backoff = 30
+# a response whose Retry-After header asks for a longer wait than this (in seconds) is returned rather than retried
+http_max_retry_after = 300
+# after this many failures in a row requests to a host are stopped for http_circuit_breaker_reset seconds, so reports fail fast while the API is down (None to never stop them)
+http_circuit_breaker_failures = 5
+http_circuit_breaker_reset = 60
+
+# maximum number of requests made at once when checking many probands (see cipapi_client.py)
+api_concurrency = 8
+
+# seconds to keep the interpretation requests found for a member (see member_index.py) before asking the API again
+member_index_ttl = 300
+# file to keep the member index in, so repeat runs share it. Comment out to only keep it in memory
+member_index_file = app_home + "member_index.json"
+# the least time in seconds between writes of member_index_file by single lookups (it is also written after each bulk lookup and at exit)
+member_index_write_interval = 60
+
+# the most file or sample ids looked up in one OpenCGA request (see opencga_client.py)
+opencga_chunk_size = 50
+
+# when creating reports for every case ready to be reported (gel_report_batch.py -a), the number of cases to read from the API per page
+sweep_page_size = 100
+# download the next page of cases while the current page is being used
+sweep_prefetch = True
+
 ################# report modifications #####################
 # Where the patient information template can be found
 new_patientinfo_table = app_home + "patient_info_table_template.html"
@@ -28,11 +71,85 @@ warning_message = "Warning! Error making the report.\nIf issue continues for thi
 # which CIP is to be used. options are "omicia", "congenica" , "nextcode","genomics_england","illumina","exomiser"
 CIP = "omicia"
 
+########################### html parsing ##########################
+# the parser beautiful soup uses to read the reports: "lxml" (fastest, pip install lxml), "html5lib" or "html.parser" (built in, slowest)
+# leave as None to use lxml if it is installed, otherwise html.parser. compare_parsers.py checks the parsers give the same report
+html_parser = None
+
 ########################### pdfkit ##########################
 # path to the wkhtmltopdf executable
 wkhtmltopdf_path = "/home/mokaguys/Apps/wkhtmltox/bin/wkhtmltopdf"
+# how many pdfs to render at once (None = one per core)
+render_workers = None
+# seconds to wait for a pdf to render before killing wkhtmltopdf
+render_timeout = 300
+# how many times to retry a render which timed out or crashed
+render_retries = 1
+# rendered pdfs are kept here by a fingerprint of their html, options, wkhtmltopdf version and render date (if the options include it); a pdf which would be identical is linked from here instead of being rendered again.
+# Keep on the same filesystem as pdf_dir so pdfs are hard linked rather than copied. Can be emptied at any time. Comment out to render every pdf
+pdf_store_dir = app_home + "pdf_store/"
+# the maximum size of pdf_store_dir in MB; the least recently used pdfs are removed above this
+pdf_store_max_mb = 1000
+
+########################### LIMS ##########################
+# number of idle database connections to keep open (see lims.py)
+lims_pool_size = 5
+# check a connection still works before reusing it if it has been idle for this many seconds
+lims_check_after = 30
+# query to fetch the LIMS records for a whole batch of probands at once. {proband_ids} is replaced by the list of IDs
+# eg "SELECT GELParticipantID, NHSNumber, FirstName, LastName, DOB, Gender, Clinician, ClinicAddress FROM Patients WHERE GELParticipantID IN ({proband_ids})"
+# leave as None to look up each proband separately in read_lims
+lims_bulk_query = None
+# the column of lims_bulk_query containing the GEL participant ID
+lims_bulk_key_column = "GELParticipantID"
+# number of IDs per query (SQL Server allows at most 2100 parameters)
+lims_bulk_chunk_size = 1000
+
+########################### Error panels ##########################
+# stop as soon as a downloaded report is found to contain an error panel (eg GEL's coverage service is down), rather than creating a pdf which will be discarded.
+# The LIMS lookup, parsing and rendering are skipped
+fail_fast_on_error_panel = False
+# reports stopped because of an error panel are queued here to be tried again (gel_report_batch.py -r). Leave as None to not queue them
+retry_queue_db = app_home + "retry_queue.db"
+# seconds to wait before the first retry. The wait doubles after each failed attempt, up to retry_max_delay
+retry_delay = 1800
+retry_max_delay = 86400
+# give up (and contact the GEL helpdesk) after this many attempts
+retry_max_attempts = 8
+
+########################### Timing ##########################
+# the time taken by each stage of each report is appended to this file as one line of json per report. Leave as None to not record timings
+timing_log = None
+
+########################### Batch mode ##########################
+# how many reports to generate at the same time when running gel_report_batch.py (with the pipeline, how many to download at once)
+batch_workers = 4
+# split the batch into download, modify and render stages which run at the same time (see pipeline.py), rather than each worker creating a whole report
+batch_pipeline = True
+# processes modifying reports in the pipeline (None = one per core). The number rendering at once is render_workers
+pipeline_transform_workers = None
+# seconds to wait for a report to be modified in the pipeline before it fails (eg if its process dies)
+pipeline_transform_timeout = 600
+# the most reports waiting between two stages of the pipeline (None = twice the workers of the next stage). Limits memory use
+pipeline_queue_size = None
+# SQLite database recording the state of each report in a batch, so an interrupted batch can be continued (gel_report_batch.py --resume). Leave as None to not record it
+work_queue_db = app_home + "work_queue.db"
+
+########################### Sync ##########################
+# SQLite database recording the inputs each pdf was created from, so gel_report_sync.py only creates pdfs whose inputs have changed
+sync_state_db = app_home + "sync_state.db"
+
+########################### Report cache ##########################
+# downloaded clinical reports are kept here so they don't need downloading again when a pdf is regenerated. Comment out to turn off the cache
+report_cache_dir = app_home + "report_cache/"
+# maximum size of the cache in MB - the least recently used reports are removed above this
+report_cache_max_mb = 500
+# check the cached report is still current with the API (using ETag/Last-Modified) before using it
+report_cache_revalidate = False
 
 ########################### Report location #################
 # Where do you want the outputs?
-html_reports = "/home/mokaguys/Documents/GeL_reports/html/" # intermediate html files
-pdf_dir = "/home/mokaguys/Documents/GeL_reports/"
\ No newline at end of file
+html_reports = "/home/mokaguys/Documents/GeL_reports/html/" # intermediate html files (only written if write_intermediate_html is True)
+pdf_dir = "/home/mokaguys/Documents/GeL_reports/"
+# write the modified html (including the patient information) to html_reports - only needed for debugging
+write_intermediate_html = False
\ No newline at end of file
@@ -0,0 +1,105 @@
+'''
+gel_report_sync.py
+This script keeps the clinical reports for every case ready to be reported (for the CIP in the config file) up to date.
+
+The inputs each pdf was created from (interpretation request, report version, cip version, report content and LIMS demographics) are recorded in a local SQLite database (see sync_state.py).
+On each sync every case is checked (as gel_report_batch.py -a), but a pdf is only created again if one of its inputs has changed since the last sync, or the pdf is missing.
+The script can be run once (eg from cron) or left running, syncing every -i minutes.
+'''
+import sys
+import getopt
+import time
+import traceback
+
+# Import local settings
+from authentication import APIAuthentication # import the function from the authentication script which generates the access token
+import gel_report_config as config # config file
+from gel_report_batch import batch
+from pipeline import start_transform_pool
+from cipapi_client import ConcurrentCIPAPIClient
+import sync_state
+
+
+class sync():
+	def __init__(self):
+		# Usage example
+		self.usage = "python gel_report_sync.py -h True/False [-i <minutes between syncs>] [-w <workers>] [-d <state database>] [-s <summary file>]"
+
+		# flag passed on to each report (see gel_report.py)
+		self.remove_headers = ""
+
+		# minutes to wait between syncs. 0 syncs once and exits (eg when run from cron)
+		self.interval = 0
+
+		# number of reports to generate at once
+		self.workers = config.batch_workers
+
+		# the SQLite database recording the inputs of each pdf
+		self.state_db = config.sync_state_db
+
+		# optional file to write the summary of each sync to
+		self.summary_file = ""
+
+	def take_inputs(self, argv):
+		'''Capture the settings from the command line and start syncing'''
+		# define expected inputs
+		try:
+			opts, args = getopt.getopt(argv, "h:i:w:d:s:", ['removeheader=', 'interval=', 'workers=', 'database=', 'summary='])
+		# raise errors with usage eg
+		except getopt.GetoptError:
+			print "ERROR - correct usage is", self.usage
+			sys.exit(2)
+
+		# loop through the arguments
+		for opt, arg in opts:
+			if opt in ("-h", "--removeheader"):
+				self.remove_headers = str(arg)
+			if opt in ("-i", "--interval"):
+				self.interval = float(arg)
+			if opt in ("-w", "--workers"):
+				self.workers = int(arg)
+			if opt in ("-d", "--database"):
+				self.state_db = str(arg)
+			if opt in ("-s", "--summary"):
+				self.summary_file = str(arg)
+
+		# the pipeline's transform processes are started before anything starts a thread (such as the render workers left
+		# by the first sync), as forking a process with running threads isn't safe. They are used by every sync
+		if batch().use_pipeline():
+			start_transform_pool()
+
+		state = sync_state.open_state(self.state_db)
+		try:
+			while True:
+				if not self.interval:
+					self.sync_once(state)
+					break
+				# an error in one sync (eg the API being down) is logged and the next sync goes ahead as normal
+				try:
+					self.sync_once(state)
+				except Exception:
+					print "sync failed %s" % time.strftime("%Y-%m-%d %H:%M:%S")
+					traceback.print_exc()
+				print "next sync in %s minutes" % self.interval
+				time.sleep(self.interval * 60)
+		finally:
+			state.close()
+
+	def sync_once(self, state):
+		'''Check every case ready to be reported, creating the pdfs whose inputs have changed. Returns the batch results'''
+		print "sync started %s" % time.strftime("%Y-%m-%d %H:%M:%S")
+		b = batch()
+		b.remove_headers = self.remove_headers
+		b.workers = self.workers
+		b.summary_file = self.summary_file
+		b.sync_state = state
+		# a new token is taken for each sync (from the token cache if it is still valid) as a long running sync may outlive it
+		b.token = APIAuthentication().token
+		results = b.run(ConcurrentCIPAPIClient(b.token).sweep_probands())
+		b.write_summary(results)
+		return results
+
+
+if __name__=="__main__":
+	s=sync()
+	s.take_inputs(sys.argv[1:])
@@ -1,7 +1,10 @@
-import requests
-import yaml
 import os
 
+import credential_registry
+import http_session
+import member_index
+import token_cache
+
 
 """
 This file will contain methods and variables common to the use of the GEL CIPAPI interface, as well as other resources
@@ -14,20 +17,14 @@ and that the populated file is added as an environment variable 'ENV_CREDENTIALS
 """
 
 
-def blind_recent_ir_and_version_from_member(member):
+def ir_and_version_from_member_json(member_json):
     """
-    a method which takes a member ID, and returns the most recent interp request and version number
+    takes the interpretation requests json for a member, and returns the interp requests with their versions
 
-    :param member: 
-    :return: 
+    :param member_json: the response from the members url (see get_generic_members_url)
+    :return: dictionary of ir: {'versions', 'recent', 'cip', 'sample_type', 'assembly'}
     """
 
-    cipapi_details = blind_get_gel_credentials_by_app('cip_api')
-    member_check_url = get_generic_members_url().format(cipapi=cipapi_details['host'], member=member)
-
-    member_json = get_url_json_response_with_header(member_check_url,
-                                                    get_cipapi_header_from_credentials(cipapi_details))
-
     feedback = {}
     if member_json:
         for result in member_json['results']:
@@ -50,70 +47,62 @@ def blind_recent_ir_and_version_from_member(member):
     return feedback
 
 
-def recent_ir_and_version_from_member_with_details(member, details):
+def blind_recent_ir_and_version_from_member(member):
     """
     a method which takes a member ID, and returns the most recent interp request and version number
-    :param member:
-    :return:
-    """
-
-    member_check_url = get_generic_members_url().format(cipapi=details['host'], member=member)
-
-    member_json = get_url_json_response_with_header(member_check_url, get_cipapi_header_from_credentials(details))
-
-    feedback = {}
-    if member_json:
-        for result in member_json['results']:
-            ir_and_version = result['interpretation_request_id']
 
-            ir, version = ir_and_version.split('-')
-            if ir not in feedback:
-                feedback[ir] = {'versions': [int(version)]}
+    :param member: 
+    :return: 
+    """
 
-            else:
-                feedback[ir]['versions'].append(int(version))
+    return recent_ir_and_version_from_member_with_details(member, blind_get_gel_credentials_by_app('cip_api'))
 
-            feedback[ir].update({'cip': result['cip'],
-                                 'sample_type': result['sample_type'],
-                                 'assembly': result['assembly']})
 
-    for ir in feedback:
-        feedback[ir]['recent'] = max(feedback[ir]['versions'])
+def recent_ir_and_version_from_member_with_details(member, details):
+    """
+    a method which takes a member ID, and returns the most recent interp request and version number
+    repeat lookups are served from the member index (see member_index.py)
+    :param member:
+    :return:
+    """
 
-    return feedback
+    return member_index.get_index().get(
+        details['host'], member,
+        lambda: ir_and_version_from_member_json(get_url_json_response_with_credentials(
+            get_generic_members_url().format(cipapi=details['host'], member=member), details)))
 
 
 def recent_ir_and_version_from_member_with_details_and_header(member, details, header):
     """
     a method which takes a member ID, and returns the most recent interp request and version number
+    repeat lookups are served from the member index (see member_index.py)
     :param member:
     :return:
     """
 
-    member_check_url = get_generic_members_url().format(cipapi=details['host'], member=member)
-
-    member_json = get_url_json_response_with_header(member_check_url, header)
-
-    feedback = {}
-    if member_json:
-        for result in member_json['results']:
-            ir_and_version = result['interpretation_request_id']
-
-            ir, version = ir_and_version.split('-')
-            if ir not in feedback:
-                feedback[ir] = {'versions': [int(version)]}
+    return member_index.get_index().get(
+        details['host'], member,
+        lambda: ir_and_version_from_member_json(get_url_json_response_with_header(
+            get_generic_members_url().format(cipapi=details['host'], member=member), header)))
 
-            else:
-                feedback[ir]['versions'].append(int(version))
 
-            feedback[ir].update({'cip': result['cip'],
-                                 'sample_type': result['sample_type'],
-                                 'assembly': result['assembly']})
+def recent_ir_and_version_from_members_with_details(members, details, concurrency=8):
+    """
+    the most recent interp requests and version numbers for many members (eg a proband and their parents)
+    each member is only looked up once, members already in the member index aren't looked up again, and the rest are
+    looked up at the same time
 
-    for ir in feedback:
-        feedback[ir]['recent'] = max(feedback[ir]['versions'])
+    :param members: member IDs
+    :param details: the cip api credentials dict
+    :param concurrency: the most requests to make at once
+    :return: a dictionary of member: {ir: details}, and a dictionary of member: error message for the lookups which failed
+    """
 
-    return feedback
+    return member_index.get_index().get_many(
+        details['host'], members,
+        lambda member: ir_and_version_from_member_json(get_url_json_response_with_credentials(
+            get_generic_members_url().format(cipapi=details['host'], member=member), details)),
+        concurrency)
 
 
 def get_assumed_env_file():
@@ -145,7 +134,7 @@ def get_url_json_response(url):
     :return:
     """
 
-    response = requests.get(url=url)
+    response = http_session.get(url=url)
 
     if response.status_code != 200:
         raise ValueError(
@@ -164,7 +153,31 @@ def get_url_json_response_with_header(url, header):
     :return:
     """
 
-    response = requests.get(url=url, headers=header)
+    response = http_session.get(url=url, headers=header)
+
+    if response.status_code != 200:
+        raise ValueError(
+            "Received status: {status} for url: {url} with response: {response}".format(
+                status=response.status_code, url=url, response=response.content)
+        )
+    return response.json()
+
+
+def get_url_json_response_with_credentials(url, credentials):
+    """
+    take a URL and the cip api credentials; return the result as JSON
+    if the (cached) token is rejected with a 401 a new token is requested and the request is tried once more
+
+    :param url:
+    :param credentials: the env variables dict
+    :return:
+    """
+
+    header = get_cipapi_header_from_credentials(credentials)
+    response = http_session.get(url=url, headers=header)
+
+    if response.status_code == 401:
+        response = http_session.get(url=url, headers=refresh_cipapi_header_from_credentials(credentials, header))
 
     if response.status_code != 200:
         raise ValueError(
@@ -205,18 +218,8 @@ def get_gel_credentials(env_path):
     :return:
     """
 
-    # check the file exists
-    if not os.path.exists(env_path):
-        raise ValueError('The stated file for environment login credentials doesn\'t exist: {}'.format(env_path))
-
-    # open the file and read into python variables
-    cred_dict = yaml.load(open(env_path))
-
-    # repackage the list of dictinoaries as a dictionary of dictionaries - reference credentials by name
-    credentials = {entry['name']: entry for entry in cred_dict}
-
-    # return the contents in dictionary form
-    return credentials
+    # the file is only parsed again if it has changed (see credential_registry.py)
+    return credential_registry.get_registry().credentials(env_path)
 
 
 def get_gel_credentials_by_app(env_path, app):
@@ -229,18 +232,8 @@ def get_gel_credentials_by_app(env_path, app):
     :return:
     """
 
-    # check the file exists
-    if not os.path.exists(env_path):
-        raise ValueError('The stated file for environment login credentials doesn\'t exist: {}'.format(env_path))
-
-    # open the file and read into python variables
-    cred_dict = yaml.load(open(env_path))
-
-    # identify the credential sets which were found, list under the resource name
-    credentials = {entry['name']: entry for entry in cred_dict}
-
-    # return the contents in dictionary form
-    return credentials[app]
+    # the file is only parsed again if it has changed (see credential_registry.py)
+    return credential_registry.get_registry().credentials_by_name(env_path, app)
 
 
 def blind_get_gel_credentials():
@@ -251,14 +244,8 @@ def blind_get_gel_credentials():
     :return:
     """
 
-    # open the file and read into python variables
-    cred_dict = yaml.load(open(get_assumed_env_file()))
-
-    # identify the credential sets which were found, list under the resource name
-    credentials = {entry['name']: entry for entry in cred_dict}
-
-    # return the contents in dictionary form
-    return credentials
+    # the file is only parsed again if it has changed (see credential_registry.py)
+    return credential_registry.get_registry().credentials(os.getenv('ENV_CREDENTIALS'))
 
 
 def blind_get_gel_credentials_by_app(app):
@@ -272,38 +259,64 @@ def blind_get_gel_credentials_by_app(app):
     :return:
     """
 
-    # open the file and read into python variables
-    cred_dict = yaml.load(open(get_assumed_env_file()))
+    # the file is only parsed again if it has changed (see credential_registry.py)
+    return credential_registry.get_registry().credentials_by_name(os.getenv('ENV_CREDENTIALS'), app)
 
-    # identify the credential sets which were found, list under the resource name
-    credentials = {entry['name']: entry for entry in cred_dict}
 
-    # return the contents in dictionary form
-    return credentials[app]
+def blind_get_cipapi_session(app='cip_api'):
+    """
+    an authenticated session for the CIP-API credentials for <app> in the environment file, which adds the
+    (cached) token to each request. The same session is returned until the credentials change
 
+    :param app: name of a CIP-API with credentials in the environment file
+    :return: a credential_registry.CIPAPISession, with get(url) and get_json(url) methods
+    """
 
-def get_cipapi_header(url, username, password):
+    return credential_registry.get_registry().session(os.getenv('ENV_CREDENTIALS'), app)
+
+
+def request_cipapi_token(url, username, password):
     """
-    manually send login details to get a header for the cipapi
+    manually send login details to the get-token interface to get a new token (bypassing the token cache)
     could feasibly provide tokens for any other JWT service using get-token interface
 
     :param url:
     :param username:
     :param password:
-    :return:
+    :return: the token
     """
 
     auth_endpoint = "/get-token/"
 
-    irl_response = requests.post(
+    irl_response = http_session.post(
         url=url + auth_endpoint,
         json=dict(
             username=username,
             password=password,
         ),
     )
-    irl_response_json = irl_response.json()
-    token = irl_response_json.get('token')
+
+    if irl_response.status_code != 200 or not irl_response.json().get('token'):
+        raise ValueError(
+            "Received status: {status} for url: {url} with response: {response}".format(
+                status=irl_response.status_code, url=url + auth_endpoint, response=irl_response.content)
+        )
+    return irl_response.json().get('token')
+
+
+def get_cipapi_header(url, username, password):
+    """
+    get an authenticated header for the cipapi
+    the token is cached (see token_cache.py), so a new one is only requested when the cached token is about to expire
+
+    :param url:
+    :param username:
+    :param password:
+    :return:
+    """
+
+    token = token_cache.get_cache().get(url + '|' + username,
+                                        lambda: request_cipapi_token(url, username, password))
 
     auth_header = {
         'Accept': 'application/json',
@@ -320,31 +333,28 @@ def get_cipapi_header_from_credentials(credentials):
     :return:
     """
 
-    url = credentials['host']
-    username = credentials['username']
-    password = credentials['password']
-    auth_endpoint = "/get-token/"
+    return get_cipapi_header(credentials['host'], credentials['username'], credentials['password'])
 
-    irl_response = requests.post(
-        url=url + auth_endpoint,
-        json=dict(
-            username=username,
-            password=password,
-        ),
-    )
-    irl_response_json = irl_response.json()
-    token = irl_response_json.get('token')
 
-    auth_header = {
-        'Accept': 'application/json',
-        "Authorization": "JWT {token}".format(token=token),
-    }
-    return auth_header
+def refresh_cipapi_header_from_credentials(credentials, rejected_header):
+    """
+    discard the cached token in a header which has been rejected by the cipapi (eg a 401 response), and get a new header
+
+    :param credentials: the env variables dict
+    :param rejected_header: the header which was rejected
+    :return:
+    """
+
+    rejected_token = rejected_header['Authorization'].split(' ', 1)[-1]
+    token_cache.get_cache().invalidate(credentials['host'] + '|' + credentials['username'], rejected_token)
+
+    return get_cipapi_header_from_credentials(credentials)
 
 
 def get_opencga_sid(credentials):
     """
     a generic method for getting a valid session ID in opencga using the REST API
+    this always logs in; use get_cached_opencga_sid to reuse a session ID
 
     :param credentials:
     :return:
@@ -355,7 +365,7 @@ def get_opencga_sid(credentials):
     )
     full_url = credentials['host'] + endpoint_ext
 
-    sid_response = requests.post(
+    sid_response = http_session.post(
         url=full_url,
         json=dict(
             password=credentials['password']
@@ -375,13 +385,45 @@ def get_opencga_sid(credentials):
                 return result['sessionId']
 
 
+def get_cached_opencga_sid(credentials):
+    """
+    a session ID for opencga, only logging in again when the cached one has expired (see token_cache.py)
+
+    :param credentials:
+    :return:
+    """
+
+    def login():
+        sid = get_opencga_sid(credentials)
+        # don't cache a failed login
+        if not sid:
+            raise ValueError('No session ID returned by opencga for user: {}'.format(credentials['username']))
+        return sid
+
+    return token_cache.get_cache().get(credentials['host'] + '|' + credentials['username'], login)
+
+
+def refresh_opencga_sid(credentials, rejected_sid):
+    """
+    discard a session ID which has been rejected by opencga, and log in again
+
+    :param credentials:
+    :param rejected_sid:
+    :return:
+    """
+
+    token_cache.get_cache().invalidate(credentials['host'] + '|' + credentials['username'], rejected_sid)
+    return get_cached_opencga_sid(credentials)
+
+
 def complete_sid_process():
     """
     everything required to generate a SID for OpenCGA, chained together for simplicity
+    the session ID is cached, so this only logs in when the cached one has expired
     :return:
     """
 
-    return get_opencga_sid(blind_get_gel_credentials_by_app('opencga_rest'))
+    return get_cached_opencga_sid(blind_get_gel_credentials_by_app('opencga_rest'))
 
 
 
@@ -0,0 +1,99 @@
+"""
+Shared HTTP session used for all requests to the CIP-API (and the other services in generic_methods)
+
+One requests.Session is created per process so connections are kept alive and reused between calls,
+rather than a new TCP connection and TLS handshake being made for every request.
+Requests made with get and post are rate limited and retried if they fail (see request_policy.py), and time out
+if the server doesn't respond.
+The proxy (given with each request) and connection pool size are read from gel_report_config (if it can be imported).
+"""
+import requests
+from requests.adapters import HTTPAdapter
+
+import request_policy
+from shared import config, SharedInstance
+
+
+# the session shared by the whole process, created on first use
+_session = SharedInstance(lambda: new_session(pool_size=getattr(config, 'http_pool_size', 10)))
+
+
+def new_session(pool_size=10):
+    """
+    create a requests session with a connection pool of the given size
+
+    :param pool_size: the number of connections to keep open to each host
+    :return: a requests.Session
+    """
+
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def get_session():
+    """
+    returns the session shared by the whole process, creating it from the config settings on first use
+
+    :return: a requests.Session
+    """
+
+    return _session.get()
+
+
+def default_timeout():
+    """
+    the timeout used when the caller doesn't give one, so a stalled connection raises requests.exceptions.Timeout
+    (and is retried) rather than waiting forever
+
+    :return: (connect, read) timeout in seconds, or None for no timeout
+    """
+
+    connect = getattr(config, 'http_connect_timeout', 10)
+    read = getattr(config, 'http_read_timeout', 120)
+    if connect is None and read is None:
+        return None
+    return (connect, read)
+
+
+def set_defaults(kwargs):
+    """
+    add the default timeout, and the proxy from the config file, to the arguments of a request unless the caller has
+    given them. The proxy is given with each request rather than set on the session, as requests lets proxies in the
+    environment (HTTP_PROXY etc) override the session's proxies but not those given with the request
+
+    :param kwargs: the keyword arguments of the request, changed in place
+    """
+
+    kwargs.setdefault('timeout', default_timeout())
+    proxy = getattr(config, 'proxy', None)
+    if proxy:
+        kwargs.setdefault('proxies', proxy)
+
+
+def get(url, **kwargs):
+    """
+    GET request using the shared session and request policy; takes the same arguments as requests.get
+
+    :param url:
+    :return: a requests.Response
+    """
+
+    set_defaults(kwargs)
+    return request_policy.get_policy().send(get_session().get, url, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    """
+    POST request using the shared session and request policy; takes the same arguments as requests.post
+
+    :param url:
+    :return: a requests.Response
+    """
+
+    set_defaults(kwargs)
+    return request_policy.get_policy().send(get_session().post, url, data=data, json=json, **kwargs)
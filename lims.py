@@ -0,0 +1,219 @@
+"""
+Connections to the local LIMS database (using pyODBC and dbconnectstring from database_connection_config.py)
+
+Connections are kept in a pool and reused between queries rather than a new connection being made (and left open) for
+every query. A connection which has been idle for a while is checked before it is reused, and broken connections are
+discarded. close_pool() closes all connections.
+
+bulk_lookup() fetches the LIMS records for many probands with one query per chunk of proband IDs (using lims_bulk_query
+from the config file), so a batch of reports doesn't need a LIMS query per proband.
+"""
+import time
+from Queue import LifoQueue, Empty, Full
+
+import pyodbc
+
+import gel_report_config as config
+from database_connection_config import dbconnectstring
+from shared import SharedInstance
+
+
+# the pool shared by the whole process, created on first use
+_pool = SharedInstance(lambda: ConnectionPool(dbconnectstring,
+                                              size=getattr(config, 'lims_pool_size', 5),
+                                              check_after=getattr(config, 'lims_check_after', 30)))
+
+
+class ConnectionPool(object):
+    """
+    A pool of pyODBC connections, holding at most <size> idle connections
+    """
+
+    def __init__(self, connect_string, size=5, check_after=30):
+        """
+        :param connect_string: the pyODBC connection string
+        :param size: the maximum number of idle connections to keep open
+        :param check_after: check a connection still works before reusing it if it has been idle for this many seconds
+        """
+
+        self.connect_string = connect_string
+        self.check_after = check_after
+
+        # (connection, time last used); the most recently used connection is reused first
+        self.idle = LifoQueue(maxsize=size)
+
+    def get(self):
+        """
+        returns an open connection, reusing an idle one if possible
+
+        :return: a pyODBC connection
+        """
+
+        while True:
+            try:
+                cnxn, last_used = self.idle.get_nowait()
+            except Empty:
+                return self.connect()
+
+            if time.time() - last_used < self.check_after or self.healthy(cnxn):
+                return cnxn
+            self.discard(cnxn)
+
+    def connect(self):
+        """ open a new connection """
+        return pyodbc.connect(self.connect_string)
+
+    def put(self, cnxn):
+        """
+        return a connection to the pool once finished with; it is closed if the pool is full
+
+        :param cnxn:
+        """
+
+        try:
+            self.idle.put_nowait((cnxn, time.time()))
+        except Full:
+            self.discard(cnxn)
+
+    def healthy(self, cnxn):
+        """ True if the connection can still run a query """
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def discard(self, cnxn):
+        """ close a connection which won't be reused """
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+
+    def query(self, query, params=None, fetch='all'):
+        """
+        run a query on a pooled connection
+
+        :param query: the SQL, using ? for parameters
+        :param params: list of parameters for the query
+        :param fetch: 'one' to return the first row, 'all' to return all rows
+        :return: the row (or list of rows) and the column names
+        """
+
+        cnxn = self.get()
+        succeeded = False
+        try:
+            cursor = cnxn.cursor()
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            result = cursor.fetchone() if fetch == 'one' else cursor.fetchall()
+            columns = [column[0] for column in cursor.description or []]
+            cursor.close()
+            succeeded = True
+        finally:
+            # after any error the connection may be broken (or mid query) so don't reuse it, but always give up its
+            # place in the pool
+            if succeeded:
+                self.put(cnxn)
+            else:
+                self.discard(cnxn)
+
+        return result, columns
+
+    def close(self):
+        """ close all idle connections """
+        while True:
+            try:
+                cnxn, last_used = self.idle.get_nowait()
+            except Empty:
+                return
+            self.discard(cnxn)
+
+
+def get_pool():
+    """
+    returns the connection pool shared by the whole process, created on first use
+
+    :return: a ConnectionPool
+    """
+
+    return _pool.get()
+
+
+def set_pool(pool):
+    """
+    use this pool for all queries instead of one created from the config settings (eg a stand-in database when benchmarking)
+
+    :param pool: a ConnectionPool
+    """
+
+    _pool.set(pool)
+
+
+def close_pool():
+    """
+    close all pooled connections (eg at the end of a batch)
+    """
+
+    if _pool.instance is not None:
+        _pool.instance.close()
+
+
+def fetchone(query, params=None):
+    """
+    run a query and return the first row (or None)
+
+    :param query: the SQL, using ? for parameters
+    :param params: list of parameters for the query
+    :return:
+    """
+
+    return get_pool().query(query, params, fetch='one')[0]
+
+
+def fetchall(query, params=None):
+    """
+    run a query and return all rows
+
+    :param query: the SQL, using ? for parameters
+    :param params: list of parameters for the query
+    :return:
+    """
+
+    return get_pool().query(query, params, fetch='all')[0]
+
+
+def bulk_lookup(proband_ids, query=None, key_column=None, chunk_size=None):
+    """
+    fetch the LIMS records for many probands, running one query per chunk of proband IDs.
+    The query must contain {proband_ids} where the list of IDs goes, eg "... WHERE GELParticipantID IN ({proband_ids})".
+    The IDs are passed as parameters; SQL Server allows at most 2100 parameters per query so they are split into chunks
+
+    :param proband_ids:
+    :param query: defaults to lims_bulk_query in the config file
+    :param key_column: the column containing the proband ID (defaults to lims_bulk_key_column in the config file)
+    :param chunk_size: the number of IDs per query (defaults to lims_bulk_chunk_size in the config file)
+    :return: a dictionary of proband_id: {column name: value}. Probands not found in the LIMS are not included
+    """
+
+    query = query or config.lims_bulk_query
+    key_column = key_column or config.lims_bulk_key_column
+    chunk_size = min(chunk_size or getattr(config, 'lims_bulk_chunk_size', 1000), 2000)
+
+    # remove duplicates
+    proband_ids = sorted(set(str(proband_id) for proband_id in proband_ids))
+
+    records = {}
+    for start in range(0, len(proband_ids), chunk_size):
+        chunk = proband_ids[start:start + chunk_size]
+        rows, columns = get_pool().query(query.format(proband_ids=",".join(["?"] * len(chunk))), chunk)
+        for row in rows:
+            record = dict(zip(columns, row))
+            records[str(record[key_column])] = record
+
+    return records
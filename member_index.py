@@ -0,0 +1,173 @@
+"""
+Index of the interpretation requests for each member (proband or relative) in the CIP-API
+
+Reconciliation calls the generic_methods member lookups for the same family members over and over (eg a proband and
+both parents), and each lookup was a full request to the API. The index keeps the result of each lookup,
+member: {ir: {'versions', 'recent', 'cip', 'sample_type', 'assembly'}}, for ttl seconds so repeat lookups are served
+from memory. If a file is set in gel_report_config (member_index_file) the index is also kept on disk, so repeat runs
+share it. The lookups are written to the file at most every write_interval seconds, at the end of each get_many and when
+the process exits, merged with those written by other processes.
+"""
+import atexit
+import copy
+import json
+import os
+import threading
+import time
+
+from shared import bounded_map, config, FileLock, SharedInstance
+
+
+# the index shared by the whole process, created on first use
+_index = SharedInstance(lambda: MemberIndex(ttl=getattr(config, 'member_index_ttl', 300),
+                                            path=getattr(config, 'member_index_file', None),
+                                            write_interval=getattr(config, 'member_index_write_interval', 60)))
+
+
+class MemberIndex(object):
+    """
+    Lookups by member ID, each kept for ttl seconds, in memory and optionally in a file on disk
+    """
+
+    def __init__(self, ttl=300, path=None, write_interval=60):
+        """
+        :param ttl: seconds to keep a lookup before asking the API again
+        :param path: file to store the index in. If None the index is only kept in memory
+        :param write_interval: the least time (in seconds) between writes of the file by single lookups
+        """
+
+        self.ttl = ttl
+        self.path = path
+        self.write_interval = write_interval
+
+        # key (host|member): {'feedback': {ir: details}, 'fetched': seconds since epoch}
+        self.entries = self._read()
+        # the keys looked up since the file was last written, and when that was
+        self.changed = set()
+        self.written = time.time()
+        self.lock = threading.Lock()
+
+        if self.path:
+            atexit.register(self.write)
+
+    def get(self, host, member, fetch):
+        """
+        the lookup for a member, calling fetch() if it isn't in the index (or has expired)
+
+        :param host: the CIP-API the member is looked up in
+        :param member: the member ID
+        :param fetch: function returning the lookup for the member from the API
+        :return: dictionary of ir: details (a copy, so it can be changed by the caller)
+        """
+
+        key = self._key(host, member)
+        with self.lock:
+            entry = self.entries.get(key)
+        if not self._fresh(entry):
+            entry = self._store(key, fetch())
+            if time.time() - self.written >= self.write_interval:
+                self.write()
+        return copy.deepcopy(entry['feedback'])
+
+    def get_many(self, host, members, fetch, concurrency=8):
+        """
+        the lookups for many members. Each member is only looked up once, those not in the index are fetched at the
+        same time (at most <concurrency> at once) and the index is written to disk once at the end
+
+        :param host: the CIP-API the members are looked up in
+        :param members: member IDs
+        :param fetch: function taking a member ID and returning its lookup from the API
+        :param concurrency: the most requests to make at once
+        :return: a dictionary of member: {ir: details}, and a dictionary of member: error message for the lookups which failed
+        """
+
+        results = {}
+
+        missing = []
+        with self.lock:
+            for member in set(members):
+                entry = self.entries.get(self._key(host, member))
+                if self._fresh(entry):
+                    results[member] = copy.deepcopy(entry['feedback'])
+                else:
+                    missing.append(member)
+
+        if not missing:
+            return results, {}
+
+        fetched, errors = bounded_map(fetch, missing, concurrency)
+        for member, feedback in fetched.items():
+            results[member] = copy.deepcopy(self._store(self._key(host, member), feedback)['feedback'])
+
+        self.write()
+        return results, errors
+
+    def _key(self, host, member):
+        return '{}|{}'.format(host, member)
+
+    def _fresh(self, entry):
+        """ True if the entry exists and hasn't expired """
+        return entry is not None and entry['fetched'] + self.ttl > time.time()
+
+    def _store(self, key, feedback):
+        """ add a lookup to the index, returning its entry """
+        entry = {'feedback': feedback, 'fetched': time.time()}
+        with self.lock:
+            self.entries[key] = entry
+            self.changed.add(key)
+        return entry
+
+    def write(self):
+        """
+        write the lookups made since the last write to the index file. The file is locked while it is read and
+        written, and the lookups already in it (eg written by another process) are kept unless this index has a newer
+        one, and are added to this index
+        """
+
+        if not self.path:
+            return
+
+        with self.lock:
+            if not self.changed:
+                return
+            changed = self.changed
+            self.changed = set()
+            self.written = time.time()
+
+        with FileLock(self.path + '.lock'):
+            entries = self._read()
+            with self.lock:
+                for key in changed:
+                    if key not in entries or entries[key]['fetched'] < self.entries[key]['fetched']:
+                        entries[key] = self.entries[key]
+                for key, entry in entries.items():
+                    if key not in self.entries or self.entries[key]['fetched'] < entry['fetched']:
+                        self.entries[key] = entry
+
+            # written to a temp file then renamed so readers never see a partial file
+            temp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.current_thread().ident)
+            with open(temp_path, 'w') as index_file:
+                json.dump(entries, index_file)
+            os.rename(temp_path, self.path)
+
+    def _read(self):
+        """ read the index from its file, dropping expired entries """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as index_file:
+                entries = json.load(index_file)
+        except ValueError:
+            # a corrupt index file is treated as empty and overwritten on the next write
+            return {}
+        return dict((key, entry) for key, entry in entries.items() if self._fresh(entry))
+
+
+def get_index():
+    """
+    returns the index shared by the whole process, created from the config settings on first use
+
+    :return: a MemberIndex
+    """
+
+    return _index.get()
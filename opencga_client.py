@@ -0,0 +1,172 @@
+"""
+Client for looking up the file and sample metadata of many samples in OpenCGA, eg resolving the BAM and VCF locations
+for a whole cohort.
+
+The session ID is cached (see generic_methods.get_cached_opencga_sid) so the client only logs in when it has expired,
+the study for each assembly and disease is only resolved once, and the ids are looked up with OpenCGA's comma separated
+multi-id queries, a chunk of ids per request, with the chunks requested at the same time by a bounded pool of threads.
+"""
+import re
+
+import generic_methods
+import http_session
+from shared import bounded_map, config
+
+
+class OpenCGAClient(object):
+    """
+    Looks up OpenCGA files and samples many at a time, with at most <concurrency> requests in flight
+    """
+
+    def __init__(self, credentials=None, concurrency=None, chunk_size=None):
+        """
+        :param credentials: the opencga credentials dict. If None the opencga_rest credentials are read from the
+        environment file (see generic_methods.blind_get_gel_credentials_by_app)
+        :param concurrency: the maximum number of requests in flight (defaults to api_concurrency in the config file)
+        :param chunk_size: the most ids in one request (defaults to opencga_chunk_size in the config file)
+        """
+
+        self.credentials = credentials or generic_methods.blind_get_gel_credentials_by_app('opencga_rest')
+        self.concurrency = concurrency or getattr(config, 'api_concurrency', 8)
+        self.chunk_size = chunk_size or getattr(config, 'opencga_chunk_size', 50)
+
+        # (assembly, disease, somatic): study id
+        self.studies = {}
+
+    def sid(self):
+        """ the cached session ID """
+        return generic_methods.get_cached_opencga_sid(self.credentials)
+
+    def study(self, assembly, disease, somatic=False):
+        """
+        the study for an assembly and disease (see generic_methods.return_study_from_assembly_and_type), resolved once
+
+        :return: the study id, or False if there isn't one
+        """
+
+        key = (assembly, disease, somatic)
+        if key not in self.studies:
+            self.studies[key] = generic_methods.return_study_from_assembly_and_type(assembly, disease, somatic)
+        return self.studies[key]
+
+    def get_json(self, url_template, **fields):
+        """
+        GET an opencga url, filling in the host and session ID. If the session ID is rejected (401/403) the client logs
+        in again and the request is tried once more
+
+        :param url_template: eg generic_methods.get_generic_single_file_url()
+        :param fields: the other fields in the template
+        :return: the result as JSON
+        """
+
+        sid = self.sid()
+        url = url_template.format(opencga=self.credentials['host'], sid=sid, **fields)
+        response = http_session.get(url)
+
+        if response.status_code in (401, 403):
+            url = url_template.format(opencga=self.credentials['host'],
+                                      sid=generic_methods.refresh_opencga_sid(self.credentials, sid), **fields)
+            response = http_session.get(url)
+
+        if response.status_code != 200:
+            raise ValueError(
+                "Received status: {status} for url: {url} with response: {response}".format(
+                    status=response.status_code, url=re.sub('sid=[^&]*', 'sid=<sid>', url), response=response.content)
+            )
+        return response.json()
+
+    def map_chunks(self, function, ids):
+        """
+        call function(chunk) for each chunk of (unique) ids, with at most <concurrency> calls running at once.
+        An error for one chunk doesn't stop the others
+
+        :param function: takes a tuple of ids and returns a dictionary of id: result
+        :param ids:
+        :return: a dictionary of id: result, and a dictionary of id: error message for the ids which failed
+        """
+
+        unique_ids = sorted(set(str(item) for item in ids))
+        chunks = [tuple(unique_ids[start:start + self.chunk_size]) for start in range(0, len(unique_ids), self.chunk_size)]
+        if not chunks:
+            return {}, {}
+
+        # log in once before the requests are made, rather than each thread finding there isn't a session ID
+        self.sid()
+
+        chunk_results, chunk_errors = bounded_map(function, chunks, self.concurrency)
+
+        results = {}
+        errors = {}
+        for chunk in chunks:
+            for item in chunk:
+                if chunk in chunk_errors:
+                    errors[item] = chunk_errors[chunk]
+                elif item in chunk_results[chunk]:
+                    results[item] = chunk_results[chunk][item]
+                else:
+                    errors[item] = "not found in study"
+        return results, errors
+
+    def files(self, file_ids, study):
+        """
+        the info for each file (eg its uri, to find the BAM or VCF)
+
+        :param file_ids: opencga file ids
+        :param study: the study id (see study)
+        :return: a dictionary of file_id: file info, and a dictionary of file_id: error message
+        """
+
+        def lookup(chunk):
+            json_response = self.get_json(generic_methods.get_generic_single_file_url(), file=','.join(chunk), study=study)
+            # there is a response for each file, in the order they were asked for
+            results = {}
+            for file_id, response in zip(chunk, json_response['response']):
+                if response['numResults']:
+                    results[file_id] = response['result'][0]
+            return results
+
+        return self.map_chunks(lookup, file_ids)
+
+    def samples(self, names, study):
+        """
+        the details of each sample in a study
+
+        :param names: sample names
+        :param study: the study id (see study)
+        :return: a dictionary of name: list of matching samples, and a dictionary of name: error message
+        """
+
+        def lookup(chunk):
+            json_response = self.get_json(generic_methods.get_generic_sample_study_url(), study=study, name=','.join(chunk))
+            results = {}
+            for response in json_response['response']:
+                for sample in response['result']:
+                    results.setdefault(str(sample['name']), []).append(sample)
+            return results
+
+        return self.map_chunks(lookup, names)
+
+    def cohort_samples(self, samples):
+        """
+        the sample details for many samples with different assemblies and diseases; the samples for each study are
+        looked up together
+
+        :param samples: list of (name, assembly, disease) or (name, assembly, disease, somatic)
+        :return: a dictionary of name: list of matching samples, and a dictionary of name: error message
+        """
+
+        by_study = {}
+        errors = {}
+        for sample in samples:
+            study = self.study(*sample[1:])
+            if study:
+                by_study.setdefault(study, []).append(sample[0])
+            else:
+                errors[str(sample[0])] = "no study for assembly {} and disease {}".format(sample[1], sample[2])
+
+        results = {}
+        for study, names in by_study.items():
+            study_results, study_errors = self.samples(names, study)
+            results.update(study_results)
+            errors.update(study_errors)
+        return results, errors
@@ -0,0 +1,369 @@
+"""
+Pool for rendering reports to PDF with wkhtmltopdf
+
+wkhtmltopdf has no server mode, so a process has to be started for each PDF. Rather than rendering one report at a time,
+renders are queued to a bounded pool of workers (by default one per core), each running its own wkhtmltopdf process.
+Each render has a timeout after which the wkhtmltopdf process is killed, and renders which time out or crash
+(eg wkhtmltopdf is killed by a signal) are retried, so one bad report doesn't hold up or break the rest of the queue.
+
+If a PdfStore is used, each pdf is stored under a fingerprint of the html, the wkhtmltopdf options and the wkhtmltopdf
+version (and the date, if the options have wkhtmltopdf fill it in, eg in the footer). A render whose fingerprint is
+already in the store is skipped and the stored pdf is linked into place instead, so rerunning a batch (eg after a failure or a change which doesn't affect most reports) only renders the reports which differ.
+The least recently used pdfs are removed from the store when it grows past its size limit.
+"""
+import errno
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pdfkit
+
+import gel_report_config as config
+from shared import SharedInstance
+
+
+# the pool (and pdf store) shared by the whole process, created on first use
+_store = SharedInstance(lambda: PdfStore(config.pdf_store_dir, max_size_mb=getattr(config, 'pdf_store_max_mb', 1000)),
+                        setting='pdf_store_dir')
+_pool = SharedInstance(lambda: RenderPool(config.wkhtmltopdf_path,
+                                          workers=getattr(config, 'render_workers', None),
+                                          timeout=getattr(config, 'render_timeout', 300),
+                                          retries=getattr(config, 'render_retries', 1),
+                                          store=get_store()))
+
+# the placeholders wkhtmltopdf replaces with the date or time of the render in the header and footer options, and
+# their formats
+render_time_placeholders = {'[date]': '%x', '[isodate]': '%Y-%m-%d', '[time]': '%X'}
+
+
+class RenderTimeout(Exception):
+    """ wkhtmltopdf didn't finish rendering within the timeout """
+    pass
+
+
+class RenderCrash(Exception):
+    """ wkhtmltopdf was killed by a signal """
+    pass
+
+
+class RenderPool(object):
+    """
+    Renders html to PDF using at most <workers> wkhtmltopdf processes at once
+    """
+
+    def __init__(self, wkhtmltopdf_path, workers=None, timeout=300, retries=1, store=None):
+        """
+        :param wkhtmltopdf_path: path to the wkhtmltopdf executable
+        :param workers: the number of renders to run at once (defaults to the number of cores)
+        :param timeout: seconds to wait for a render before killing wkhtmltopdf
+        :param retries: how many times to retry a render which timed out or crashed
+        :param store: optional PdfStore; renders already in the store are skipped
+        """
+
+        self.configuration = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf_path)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.store = store
+        self.version = wkhtmltopdf_version(wkhtmltopdf_path) if store else None
+
+        # renders are queued to the pool; each worker thread waits on its own wkhtmltopdf process
+        self.pool = ThreadPool(self.workers)
+
+    def submit(self, html, pdf_path, options=None):
+        """
+        queue a render
+
+        :param html: the html to render
+        :param pdf_path: where to write the pdf
+        :param options: wkhtmltopdf options, as used by pdfkit
+        :return: a multiprocessing AsyncResult; get() returns the pdf path or raises the render error
+        """
+
+        return self.pool.apply_async(self.render_with_retries, (html, pdf_path, options))
+
+    def render(self, html, pdf_path, options=None):
+        """
+        queue a render and wait for it to finish
+
+        :param html: the html to render
+        :param pdf_path: where to write the pdf
+        :param options: wkhtmltopdf options, as used by pdfkit
+        :return: the pdf path
+        """
+
+        return self.submit(html, pdf_path, options).get()
+
+    def render_with_retries(self, html, pdf_path, options=None):
+        """
+        render the pdf (unless an identical render is in the store), retrying if wkhtmltopdf times out or crashes
+
+        :return: the pdf path
+        """
+
+        if not self.store:
+            return self.render_attempts(html, pdf_path, options)
+
+        key = fingerprint(html, options, self.version)
+        if self.store.link(key, pdf_path):
+            print "identical pdf already rendered, linked to {}".format(pdf_path)
+            return pdf_path
+
+        # render to a new file then move it into place, so a pdf linked from the store is never overwritten
+        temp_path = '{}.{}.tmp.pdf'.format(pdf_path, threading.current_thread().ident)
+        try:
+            self.render_attempts(html, temp_path, options)
+            os.rename(temp_path, pdf_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.store.add(key, pdf_path)
+        return pdf_path
+
+    def render_attempts(self, html, pdf_path, options=None):
+        """
+        render the pdf, retrying if wkhtmltopdf times out or crashes
+
+        :return: the pdf path
+        """
+
+        attempt = 0
+        while True:
+            try:
+                return render_pdf(html, pdf_path, options, self.configuration, self.timeout)
+            except (RenderTimeout, RenderCrash) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                print "retrying render of {} after error: {}".format(pdf_path, e)
+
+    def close(self):
+        """ finish any queued renders and stop the workers """
+        self.pool.close()
+        self.pool.join()
+
+
+def render_pdf(html, pdf_path, options=None, configuration=None, timeout=300):
+    """
+    render html to a pdf with a single wkhtmltopdf process, killing it if it takes longer than the timeout
+
+    :param html: the html to render
+    :param pdf_path: where to write the pdf
+    :param options: wkhtmltopdf options, as used by pdfkit
+    :param configuration: a pdfkit configuration (giving the path to wkhtmltopdf)
+    :param timeout: seconds to wait before killing wkhtmltopdf
+    :return: the pdf path
+    """
+
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+
+    # pdfkit builds the wkhtmltopdf command (including any options set in meta tags in the html); the html is passed on stdin
+    args = pdfkit.PDFKit(html, 'string', options=options, configuration=configuration).command(pdf_path)
+
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # kill wkhtmltopdf if it is still running after the timeout
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            process.kill()
+        except OSError:
+            # already finished
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        stdout, stderr = process.communicate(input=html)
+    finally:
+        timer.cancel()
+
+    if timed_out.is_set():
+        raise RenderTimeout("wkhtmltopdf took longer than {} seconds to render {}".format(timeout, pdf_path))
+    if process.returncode < 0:
+        raise RenderCrash("wkhtmltopdf was killed by signal {} rendering {}".format(-process.returncode, pdf_path))
+    if process.returncode != 0:
+        raise IOError("wkhtmltopdf exited with non-zero code {} rendering {}:\n{}".format(process.returncode, pdf_path, stderr or stdout))
+
+    return pdf_path
+
+
+class PdfStore(object):
+    """
+    Rendered pdfs stored in a directory by fingerprint (<fingerprint>.pdf)
+    """
+
+    def __init__(self, directory, max_size_mb=1000):
+        """
+        :param directory: where to store the pdfs. It should be on the same filesystem as the pdf output directory so
+        pdfs can be hard linked rather than copied
+        :param max_size_mb: the maximum size of the store; least recently used pdfs are removed above this
+        """
+
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, key):
+        """ the stored pdf path for this fingerprint """
+        return os.path.join(self.directory, key + '.pdf')
+
+    def link(self, key, pdf_path):
+        """
+        put the stored pdf for this fingerprint at pdf_path
+
+        :param key: the fingerprint
+        :param pdf_path:
+        :return: True if the pdf was in the store, False if it needs rendering
+        """
+
+        stored_path = self.path(key)
+        if not os.path.isfile(stored_path):
+            return False
+        try:
+            if not (os.path.isfile(pdf_path) and os.path.samefile(stored_path, pdf_path)):
+                place(stored_path, pdf_path)
+            # record the use so this pdf is evicted last
+            os.utime(stored_path, None)
+        except (IOError, OSError):
+            # eg removed from the store by another process
+            return False
+        return True
+
+    def add(self, key, pdf_path):
+        """
+        store a newly rendered pdf under its fingerprint
+
+        :param key: the fingerprint
+        :param pdf_path:
+        """
+
+        place(pdf_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently used pdfs until the store is under its size limit """
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.pdf'):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, filename))
+                    except OSError:
+                        # removed by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+                    total += stat.st_size
+
+            for mtime, size, filename in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+                total -= size
+
+
+def place(source, destination):
+    """
+    hard link source to destination (copying if they are on different filesystems), replacing any existing file.
+    A temp file is renamed into place so a reader never sees a partial file
+
+    :param source:
+    :param destination:
+    """
+
+    temp_path = '{}.{}.tmp'.format(destination, threading.current_thread().ident)
+    if os.path.exists(temp_path):
+        # left by a run which was interrupted
+        os.remove(temp_path)
+    try:
+        os.link(source, temp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copyfile(source, temp_path)
+    os.rename(temp_path, destination)
+
+
+def fingerprint(html, options, version):
+    """
+    fingerprint of everything which determines the pdf: the html, the wkhtmltopdf options, the wkhtmltopdf version and
+    the values of any date or time placeholders in the options (so a pdf rendered on another day isn't reused)
+
+    :param html:
+    :param options: wkhtmltopdf options, as used by pdfkit
+    :param version: the wkhtmltopdf version
+    :return: hex digest
+    """
+
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+
+    digest = hashlib.sha1()
+    digest.update(json.dumps([options or {}, version, render_time_values(options)], sort_keys=True))
+    digest.update(html)
+    return digest.hexdigest()
+
+
+def render_time_values(options):
+    """
+    the values wkhtmltopdf would fill in now for the date and time placeholders used in the options
+
+    :param options: wkhtmltopdf options, as used by pdfkit
+    :return: dictionary of placeholder: value
+    """
+
+    text = json.dumps(options or {})
+    return dict((placeholder, time.strftime(date_format)) for placeholder, date_format in render_time_placeholders.items()
+                if placeholder in text)
+
+
+def wkhtmltopdf_version(wkhtmltopdf_path):
+    """
+    the version reported by wkhtmltopdf, so pdfs are rendered again when wkhtmltopdf is upgraded
+
+    :param wkhtmltopdf_path:
+    :return: the version string (or the path if it can't be read)
+    """
+
+    try:
+        process = subprocess.Popen([wkhtmltopdf_path, '--version'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate('')
+    except OSError:
+        return wkhtmltopdf_path
+    return stdout.strip() or wkhtmltopdf_path
+
+
+def get_store():
+    """
+    returns the pdf store shared by the whole process, or None if pdf_store_dir isn't set in the config file
+
+    :return: a PdfStore or None
+    """
+
+    return _store.get()
+
+
+def get_pool():
+    """
+    returns the render pool shared by the whole process, created from the config settings on first use
+
+    :return: a RenderPool
+    """
+
+    return _pool.get()
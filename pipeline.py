@@ -0,0 +1,229 @@
+"""
+Pipeline for creating many reports at once (gel_report_batch.py)
+
+Creating a report has three very different stages:
+    fetch     - reading the API, downloading the report and the LIMS lookup (waiting on the network/database)
+    transform - parsing and modifying the report with beautiful soup (CPU bound)
+    render    - wkhtmltopdf (a separate process per report)
+Running each report's stages in sequence leaves the CPU idle during downloads and the network idle during renders, and
+as python threads can't parse more than one report at a time the transform stage runs in a pool of processes.
+Each stage has its own workers and takes reports from a bounded queue, so a slow stage holds up the stages before it
+rather than reports piling up in memory.
+
+Forking a process while other threads are running isn't safe, so the pool of transform processes is created once per
+process by start_transform_pool(), which the scripts call before anything starts a thread, and is reused by every
+pipeline run in the process.
+"""
+import multiprocessing
+import sys
+import threading
+from Queue import Queue
+
+from gel_report import connect
+import gel_report_config as config
+from shared import SharedInstance
+
+
+# passed along a queue to tell the next stage's workers there are no more reports
+_DONE = object()
+
+# the status written to the timing log (as used by connect.generate_report) for each result status
+timing_status = {"SUCCESS": "created", "UNCHANGED": "unchanged", "FAILED": "failed"}
+
+# the transform processes shared by every pipeline in the process, created by start_transform_pool
+_transform_pool = SharedInstance(lambda: multiprocessing.Pool(transform_workers()))
+
+
+class ReportPipeline(object):
+    """
+    Creates reports in fetch, transform and render stages, each with its own workers
+    """
+
+    def __init__(self, new_connect, fetch_workers=4, render_workers=None, queue_size=None, transform_timeout=None):
+        """
+        :param new_connect: function taking a proband ID and returning a gel_report.connect set up to create its report
+        :param fetch_workers: the number of reports to download (and read from the LIMS) at once
+        :param render_workers: the number of reports to render at once (defaults to the number of cores)
+        :param queue_size: the most reports waiting between two stages (defaults to twice the workers of the next stage)
+        :param transform_timeout: seconds to wait for a report to be modified before it fails (defaults to 600)
+        """
+
+        self.new_connect = new_connect
+        self.fetch_workers = fetch_workers
+        # the reports are modified by the transform processes shared by the whole process (see start_transform_pool)
+        self.transform_workers = transform_workers()
+        self.render_workers = render_workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.transform_timeout = transform_timeout or 600
+
+        # the exception raised reading the proband IDs (eg if they come from the API), raised again once the pipeline has finished
+        self.feed_error = None
+
+    def run(self, proband_ids):
+        """
+        create the reports
+
+        :param proband_ids: list (or generator) of proband IDs
+        :return: generator of (index, proband_id, status, message) as each report finishes, where index is the position of the
+        proband in proband_ids and status is SUCCESS (message is the pdf path), UNCHANGED or FAILED (message is the error)
+        """
+
+        fetch_queue = Queue(self.queue_size or 2 * self.fetch_workers)
+        transform_queue = Queue(self.queue_size or 2 * self.transform_workers)
+        render_queue = Queue(self.queue_size or 2 * self.render_workers)
+        results = Queue()
+
+        process_pool = start_transform_pool()
+
+        threads = [start_thread(self.feed, proband_ids, fetch_queue)]
+        threads += self.start_stage(self.fetch, fetch_queue, self.fetch_workers, transform_queue, self.transform_workers, results)
+        threads += self.start_stage(lambda job: self.transform(process_pool, job), transform_queue, self.transform_workers,
+                                    render_queue, self.render_workers, results)
+        threads += self.start_stage(self.render, render_queue, self.render_workers, results, 1, results)
+
+        # the render stage sends _DONE once every report has finished
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            yield result
+
+        for thread in threads:
+            thread.join()
+
+        if self.feed_error:
+            raise self.feed_error[0], self.feed_error[1], self.feed_error[2]
+
+    def feed(self, proband_ids, fetch_queue):
+        """ put each proband ID on the fetch queue, with its position in the input """
+        try:
+            for index, proband_id in enumerate(proband_ids):
+                fetch_queue.put((index, str(proband_id), None))
+        except Exception:
+            self.feed_error = sys.exc_info()
+        finally:
+            for worker in range(self.fetch_workers):
+                fetch_queue.put(_DONE)
+
+    def start_stage(self, function, inbox, workers, outbox, next_workers, results):
+        """
+        start the workers for a stage. Each takes jobs from the inbox and calls function(job), which returns the job
+        for the next stage (put on the outbox) or a finished result (put on results). When the stage's workers have
+        all finished, the next stage's workers are told there are no more jobs
+
+        :return: the threads started
+        """
+
+        def work():
+            while True:
+                job = inbox.get()
+                if job is _DONE:
+                    return
+                index, proband_id, c = job
+                try:
+                    output = function(job)
+                # read_lims calls quit() if the patient can't be found so catch SystemExit as well, otherwise the worker is lost
+                except (Exception, SystemExit) as e:
+                    output = self.result(index, proband_id, c, "FAILED", (c and c.error) or repr(e))
+                if len(output) == 4:
+                    results.put(output)
+                else:
+                    outbox.put(output)
+
+        stage_threads = [start_thread(work) for worker in range(workers)]
+
+        def finish():
+            for thread in stage_threads:
+                thread.join()
+            for worker in range(next_workers):
+                outbox.put(_DONE)
+
+        return stage_threads + [start_thread(finish)]
+
+    def fetch(self, job):
+        """ read the API, download the report and read the LIMS """
+        index, proband_id, c = job
+        c = self.new_connect(proband_id)
+        # errors are caught here rather than by the stage worker, as the worker doesn't have the connect object (for its
+        # error message and timings)
+        try:
+            with c.timer.stage("read_API_page"):
+                json = c.read_API_page()
+            fetched = c.fetch_report(json)
+        # read_lims calls quit() if the patient can't be found
+        except (Exception, SystemExit) as e:
+            return self.result(index, proband_id, c, "FAILED", c.error or repr(e))
+        if not fetched:
+            return self.result(index, proband_id, c, "FAILED", c.error or "no report created")
+        if c.unchanged:
+            return self.result(index, proband_id, c, "UNCHANGED", c.pdf_report)
+        return index, proband_id, c
+
+    def transform(self, process_pool, job):
+        """ modify the report in one of the transform processes """
+        index, proband_id, c = job
+        pending = process_pool.apply_async(modify_report, (c.proband_id, c.remove_headers, c.html_parser, c.report, c.patient_info_dict))
+        # if the process dies (eg it runs out of memory) the pool replaces it but the result never arrives, so only this report fails
+        try:
+            html, stages = pending.get(self.transform_timeout)
+        except multiprocessing.TimeoutError:
+            c.error = "the report wasn't modified within {} seconds (the transform process may have died)".format(self.transform_timeout)
+            raise
+        for stage, seconds in stages:
+            c.timer.add(stage, seconds)
+        # the downloaded report isn't needed any more
+        c.report = None
+        c.html = html
+        return index, proband_id, c
+
+    def render(self, job):
+        """ create the pdf """
+        index, proband_id, c = job
+        c.save_report(c.html)
+        return self.result(index, proband_id, c, "SUCCESS", c.pdf_report)
+
+    def result(self, index, proband_id, c, status, message):
+        """ the finished result for a report, writing its timings to the timing log """
+        if c is not None:
+            c.timer.write(proband_id, timing_status[status], c.error or (message if status == "FAILED" else ""))
+        return index, proband_id, status, message
+
+
+def modify_report(proband_id, remove_headers, html_parser, report, patient_info_dict):
+    """
+    modify the report (run in a transform process)
+
+    :return: the modified html and the time taken by each stage as a list of (stage, seconds)
+    """
+
+    # a token is given so the process doesn't authenticate; the API isn't used
+    c = connect("transform")
+    c.proband_id = proband_id
+    c.remove_headers = remove_headers
+    c.html_parser = html_parser
+    html = c.modify_report(report, patient_info_dict)
+    return html, c.timer.stages.items()
+
+
+def transform_workers():
+    """ the number of transform processes: pipeline_transform_workers in the config file, or the number of cores """
+    return getattr(config, "pipeline_transform_workers", None) or multiprocessing.cpu_count()
+
+
+def start_transform_pool():
+    """
+    returns the pool of transform processes shared by the whole process, starting it on first use. As forking a process
+    with running threads isn't safe, this should be called before anything starts a thread
+
+    :return: a multiprocessing.Pool
+    """
+
+    return _transform_pool.get()
+
+
+def start_thread(function, *args):
+    """ start a daemon thread calling function(*args) """
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,180 @@
+"""
+Local on-disk cache of clinical report html, keyed by the report url
+
+A ClinicalReport/<ir>/<ver>/<cip_ver>/<report_ver> url always returns the same report, so once downloaded the report can be
+reused when the PDF is regenerated (eg after a LIMS correction or a template change) without downloading it again.
+Reports are stored compressed. If revalidation is switched on the cached ETag/Last-Modified are sent with the request and
+the cached copy is used if the API responds 304 Not Modified.
+The least recently used reports are removed when the cache grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+from shared import config, SharedInstance
+
+
+# the cache shared by the whole process, created on first use
+_cache = SharedInstance(lambda: ReportCache(config.report_cache_dir,
+                                            max_size_mb=getattr(config, 'report_cache_max_mb', 500),
+                                            revalidate=getattr(config, 'report_cache_revalidate', False)),
+                        setting='report_cache_dir')
+
+
+class ReportCache(object):
+    """
+    Compressed report bodies (<key>.html.z) and their headers (<key>.json) stored in a directory
+    """
+
+    def __init__(self, directory, max_size_mb=500, revalidate=False):
+        """
+        :param directory: where to store the cached reports
+        :param max_size_mb: the maximum size of the cache; least recently used reports are removed above this
+        :param revalidate: check the cached report is still current (using ETag/Last-Modified) before using it
+        """
+
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def fetch(self, url, get, cacheable=None):
+        """
+        returns the report content for this url, from the cache if possible, otherwise using get()
+
+        :param url: the report url
+        :param get: function taking (url, headers) which makes the request and returns a requests.Response
+        :param cacheable: optional function taking the content which returns False if it shouldn't be cached
+        :return: the report content. ValueError is raised if the request fails (any status but 200, or 304 for a cached report)
+        """
+
+        key = hashlib.sha1(url).hexdigest()
+        cached = self._read(key)
+
+        if cached and not self.revalidate:
+            return cached[0]
+
+        headers = {}
+        if cached:
+            if cached[1].get('etag'):
+                headers['If-None-Match'] = cached[1]['etag']
+            if cached[1].get('last_modified'):
+                headers['If-Modified-Since'] = cached[1]['last_modified']
+
+        response = get(url, headers)
+
+        if cached and response.status_code == 304:
+            return cached[0]
+
+        # an error page mustn't be returned as the report
+        if response.status_code != 200:
+            raise ValueError(
+                "Received status: {status} for url: {url} with response: {response}".format(
+                    status=response.status_code, url=url, response=response.content)
+            )
+
+        if cacheable is None or cacheable(response.content):
+            self._write(key, url, response)
+
+        return response.content
+
+    def _paths(self, key):
+        """ the body and header file paths for this key """
+        return os.path.join(self.directory, key + '.html.z'), os.path.join(self.directory, key + '.json')
+
+    def _read(self, key):
+        """ returns (content, headers) for the key, or None if it isn't cached """
+        body_path, header_path = self._paths(key)
+        try:
+            with open(header_path, 'r') as header_file:
+                headers = json.load(header_file)
+            with open(body_path, 'rb') as body_file:
+                content = zlib.decompress(body_file.read())
+        except (IOError, OSError, ValueError, zlib.error):
+            # not cached (or partially removed by an eviction)
+            return None
+
+        # record the use so this report is evicted last
+        try:
+            os.utime(body_path, None)
+        except OSError:
+            pass
+        return content, headers
+
+    def _write(self, key, url, response):
+        """ store the response, then evict old reports if the cache is too big """
+        body_path, header_path = self._paths(key)
+        headers = {'url': url,
+                   'etag': response.headers.get('ETag'),
+                   'last_modified': response.headers.get('Last-Modified')}
+
+        # write to temp files then rename, so a reader (in this or another process) never sees a partial file
+        suffix = '.{}.{}.tmp'.format(os.getpid(), threading.current_thread().ident)
+        with open(body_path + suffix, 'wb') as body_file:
+            body_file.write(zlib.compress(response.content))
+        with open(header_path + suffix, 'w') as header_file:
+            json.dump(headers, header_file)
+        os.rename(header_path + suffix, header_path)
+        os.rename(body_path + suffix, body_path)
+
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently used reports until the cache is under its size limit """
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.html.z'):
+                    stat = os.stat(os.path.join(self.directory, filename))
+                    entries.append((stat.st_mtime, stat.st_size, filename[:-len('.html.z')]))
+                    total += stat.st_size
+
+            for mtime, size, key in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+
+def has_error_panel(content):
+    """
+    True if the report contains an error panel (eg the coverage data couldn't be found). This is a plain text search so
+    is much quicker than parsing the report
+
+    :param content: the report html
+    :return:
+    """
+
+    return 'content-div error-panel' in content
+
+
+def without_errors(content):
+    """
+    reports containing an error panel are usually fixed by GEL after a short time, so shouldn't be cached.
+    Use as the cacheable function in ReportCache.fetch()
+
+    :param content: the report html
+    :return: True if the report has no error panel
+    """
+
+    return not has_error_panel(content)
+
+
+def get_cache():
+    """
+    returns the report cache shared by the whole process, or None if report_cache_dir isn't set in the config file
+
+    :return: a ReportCache or None
+    """
+
+    return _cache.get()
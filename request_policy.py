@@ -0,0 +1,286 @@
+"""
+Rate limiting, retries and circuit breaking for requests to the CIP-API (and the other services in generic_methods)
+
+Every request made through http_session goes through the RequestPolicy shared by the process:
+- a token bucket limits the requests per second to each host. When a host replies 429 (too many requests) the rate
+  is halved, and it then climbs slowly back to the configured rate, so concurrent batch workers slow down together
+  rather than each hammering the API
+- 429s, 5xx responses, connection errors, timeouts and truncated responses are retried with jittered exponential backoff, waiting as long as the
+  Retry-After header asks if one is given (unless that is longer than max_retry_after, when the response is returned)
+- if a host keeps failing, a circuit breaker stops requests to it for a while, so a batch fails fast while the API is
+  down instead of every report waiting through its retries
+The settings are read once from gel_report_config (if it can be imported).
+"""
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
+
+import requests
+
+from shared import config, SharedInstance
+
+
+# the policy shared by the whole process, created on first use
+_policy = SharedInstance(lambda: RequestPolicy(rate=getattr(config, 'http_rate_limit', None),
+                                               burst=getattr(config, 'http_rate_burst', None),
+                                               retries=getattr(config, 'http_retries', 4),
+                                               backoff=getattr(config, 'http_backoff', 0.5),
+                                               max_backoff=getattr(config, 'http_max_backoff', 30),
+                                               max_retry_after=getattr(config, 'http_max_retry_after', 300),
+                                               failure_threshold=getattr(config, 'http_circuit_breaker_failures', 5),
+                                               reset_timeout=getattr(config, 'http_circuit_breaker_reset', 60)))
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    raised instead of making a request while a host's circuit breaker is open
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate of requests, which slows down when the server says it is being sent too many
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.1):
+        """
+        :param rate: requests per second
+        :param burst: the most requests which can be made at once after a quiet period (defaults to rate)
+        :param min_rate: the rate isn't reduced below this
+        """
+
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ wait until a request can be made """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """ halve the rate (eg after a 429) """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """ move the rate back towards the configured rate after a successful request """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a host after repeated failures. After reset_timeout one request is let through; if it
+    succeeds requests carry on as normal, otherwise the breaker stays open for another reset_timeout
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        """
+        :param failure_threshold: the number of failures in a row which opens the breaker
+        :param reset_timeout: seconds to stop requests for
+        """
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # when the breaker was opened, or None if it is closed
+        self.opened = None
+        # a request is being made to test whether the host has recovered
+        self.testing = False
+        self.lock = threading.Lock()
+
+    def before(self, host):
+        """
+        call before making a request; raises CircuitOpenError if the request shouldn't be made
+
+        :param host: used in the error message
+        """
+
+        with self.lock:
+            if self.opened is None:
+                return
+            if not self.testing and time.time() - self.opened >= self.reset_timeout:
+                self.testing = True
+                return
+        raise CircuitOpenError("{host} has failed {failures} times in a row, not sending requests for {timeout} seconds".format(
+            host=host, failures=self.failures, timeout=self.reset_timeout))
+
+    def success(self):
+        """ record a request which succeeded, closing the breaker """
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.testing = False
+
+    def failure(self):
+        """ record a request which failed, opening the breaker if there have been too many """
+        with self.lock:
+            self.failures += 1
+            if self.testing or self.failures >= self.failure_threshold:
+                self.opened = time.time()
+            self.testing = False
+
+
+class RequestPolicy(object):
+    """
+    Sends requests with a rate limit, retries and a circuit breaker for each host
+    """
+
+    # responses which are worth trying again
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate=None, burst=None, retries=4, backoff=0.5, max_backoff=30, max_retry_after=300, failure_threshold=5,
+                 reset_timeout=60):
+        """
+        :param rate: the most requests per second to each host (None for no limit)
+        :param burst: the most requests to a host at once after a quiet period (defaults to rate)
+        :param retries: the number of times a failed request is tried again
+        :param backoff: the longest wait before the first retry; the longest wait doubles with each retry (the wait is
+        chosen at random up to it)
+        :param max_backoff: the longest wait between retries (unless the response has a Retry-After header)
+        :param max_retry_after: the longest Retry-After to wait for. If a response asks for a longer wait it is returned
+        rather than retried
+        :param failure_threshold: failures in a row which stop requests to a host (None to never stop them)
+        :param reset_timeout: seconds to stop requests to a failing host for
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        # host: (RateLimiter or None, CircuitBreaker or None)
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def for_host(self, host):
+        """ the rate limiter and circuit breaker for a host """
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (RateLimiter(self.rate, self.burst) if self.rate else None,
+                                    CircuitBreaker(self.failure_threshold, self.reset_timeout) if self.failure_threshold else None)
+            return self.hosts[host]
+
+    def send(self, request, url, **kwargs):
+        """
+        make a request, retrying it if it fails
+
+        :param request: function taking (url, **kwargs) and returning a requests.Response eg session.get
+        :param url:
+        :return: the response. If the retries run out the last response is returned (so the caller can report the
+        status), or the last connection error is raised
+        """
+
+        host = urlparse(url).netloc
+        limiter, breaker = self.for_host(host)
+
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.before(host)
+            if limiter:
+                limiter.acquire()
+
+            try:
+                response = request(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError):
+                if breaker:
+                    breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                response = None
+            except BaseException:
+                # any other error isn't retried, but is still recorded so a failed test request doesn't leave the breaker open
+                if breaker:
+                    breaker.failure()
+                raise
+
+            if response is not None:
+                if response.status_code not in self.retry_statuses:
+                    if breaker:
+                        breaker.success()
+                    if limiter:
+                        limiter.speed_up()
+                    return response
+                if response.status_code == 429:
+                    # the host is working, it just wants fewer requests
+                    if breaker:
+                        breaker.success()
+                    if limiter:
+                        limiter.slow_down()
+                elif breaker:
+                    breaker.failure()
+                if attempt >= self.retries:
+                    return response
+
+            wait = self.delay(attempt, response)
+            if wait is None:
+                # the server has asked for a longer wait than max_retry_after, so the response is returned rather than retried early
+                return response
+            time.sleep(wait)
+            attempt += 1
+
+    def delay(self, attempt, response=None):
+        """
+        seconds to wait before trying a request again
+
+        :param attempt: the number of retries so far
+        :param response: the failed response, if there was one. Its Retry-After header is used if it has one
+        :return: the wait in seconds, or None if the Retry-After header asks for a longer wait than max_retry_after
+        """
+
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_retry_after else None
+        # "full jitter", so workers which failed at the same time don't all try again at the same time
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def retry_after_seconds(response):
+    """
+    the wait asked for by a response's Retry-After header, which is either seconds or an http date
+
+    :param response: a requests.Response or None
+    :return: seconds, or None if there isn't a (valid) Retry-After header
+    """
+
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, mktime_tz(date) - time.time())
+
+
+def get_policy():
+    """
+    returns the policy shared by the whole process, created from the config settings on first use
+
+    :return: a RequestPolicy
+    """
+
+    return _policy.get()
@@ -0,0 +1,106 @@
+"""
+Queue of reports to try again later, kept in a local SQLite database
+
+When GEL can't produce part of a report (eg the coverage service is down) the report contains an error panel. These
+errors are usually fixed after a while, so rather than creating a pdf which will have to be discarded the proband is
+queued here and tried again later (gel_report_batch.py -r). The wait before each retry doubles, from retry_delay up to
+retry_max_delay, and a proband is given up on after retry_max_attempts.
+"""
+import time
+
+from shared import config, LocalDatabase, SharedInstance
+
+
+# the queue shared by the whole process, created on first use
+_queue = SharedInstance(lambda: RetryQueue(config.retry_queue_db,
+                                           delay=getattr(config, 'retry_delay', 1800),
+                                           max_delay=getattr(config, 'retry_max_delay', 86400),
+                                           max_attempts=getattr(config, 'retry_max_attempts', 8)),
+                        setting='retry_queue_db')
+
+
+class RetryQueue(LocalDatabase):
+    """
+    Probands waiting to be tried again, with the number of attempts so far and when to try next
+    """
+
+    schema = ["CREATE TABLE IF NOT EXISTS retries (proband_id TEXT PRIMARY KEY, attempts INTEGER, next_attempt REAL, last_error TEXT)"]
+
+    def __init__(self, path, delay=1800, max_delay=86400, max_attempts=8):
+        """
+        :param path: the SQLite database file (created if it doesn't exist)
+        :param delay: seconds to wait before the first retry; the wait doubles after each failed attempt
+        :param max_delay: the longest wait between retries
+        :param max_attempts: give up on a proband after this many failed attempts
+        """
+
+        super(RetryQueue, self).__init__(path)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def add(self, proband_id, error):
+        """
+        record a failed attempt, scheduling the next one
+
+        :param proband_id:
+        :param error: why the report couldn't be created
+        :return: the time of the next attempt (seconds since the epoch), or None if the proband has been given up on
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT attempts FROM retries WHERE proband_id = ?", (str(proband_id),)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if attempts >= self.max_attempts:
+                next_attempt = None
+            else:
+                next_attempt = time.time() + min(self.max_delay, self.delay * 2 ** (attempts - 1))
+            self.connection.execute("INSERT OR REPLACE INTO retries (proband_id, attempts, next_attempt, last_error) "
+                                    "VALUES (?, ?, ?, ?)", (str(proband_id), attempts, next_attempt, error))
+            self.connection.commit()
+        return next_attempt
+
+    def remove(self, proband_id):
+        """
+        take a proband off the queue (eg once its report has been created)
+
+        :param proband_id:
+        """
+
+        with self.lock:
+            self.connection.execute("DELETE FROM retries WHERE proband_id = ?", (str(proband_id),))
+            self.connection.commit()
+
+    def due(self, now=None):
+        """
+        the probands whose next attempt is due
+
+        :param now: defaults to the current time
+        :return: list of proband IDs, those waiting longest first
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT proband_id FROM retries WHERE next_attempt <= ? ORDER BY next_attempt",
+                                           (now or time.time(),)).fetchall()
+        return [row[0] for row in rows]
+
+    def given_up(self):
+        """
+        the probands which have failed max_attempts times
+
+        :return: list of (proband_id, attempts, last error)
+        """
+
+        with self.lock:
+            return self.connection.execute("SELECT proband_id, attempts, last_error FROM retries "
+                                           "WHERE next_attempt IS NULL ORDER BY proband_id").fetchall()
+
+
+def get_queue():
+    """
+    returns the retry queue shared by the whole process, or None if retry_queue_db isn't set in the config file
+
+    :return: a RetryQueue or None
+    """
+
+    return _queue.get()
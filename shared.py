@@ -0,0 +1,143 @@
+"""
+Helpers shared by the modules which keep state for the whole process (the http session, token cache, work queue etc)
+
+config is gel_report_config, or None if it can't be imported: generic_methods and the modules it uses can be used in
+other projects which don't have the report config file, so these modules read their settings with getattr and a default.
+"""
+import os
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking on windows - files are still shared, but concurrent processes may overwrite each other's changes
+    fcntl = None
+
+try:
+    import gel_report_config as config
+except ImportError:
+    config = None
+
+
+class SharedInstance(object):
+    """
+    An object shared by the whole process, created on first use
+    """
+
+    def __init__(self, create, setting=None):
+        """
+        :param create: function returning the object
+        :param setting: if given, the object is only created once this is set in the config file (until then get()
+        returns None)
+        """
+
+        self.create = create
+        self.setting = setting
+        self.instance = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ the shared object, created if this is the first use """
+        if self.instance is None and (self.setting is None or getattr(config, self.setting, None)):
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.create()
+        return self.instance
+
+    def set(self, instance):
+        """ use this object instead of one created by create() """
+        with self.lock:
+            self.instance = instance
+
+
+def bounded_map(function, items, concurrency):
+    """
+    call function(item) for each (unique) item in a pool of threads, with at most <concurrency> calls running at once.
+    An error for one item doesn't stop the others
+
+    :param function:
+    :param items: the items (which must be hashable, eg use tuples rather than lists)
+    :param concurrency: the most calls to run at once
+    :return: a dictionary of item: result, and a dictionary of item: error message for the items which failed
+    """
+
+    unique_items = list(set(items))
+    if not unique_items:
+        return {}, {}
+
+    def call(item):
+        try:
+            return item, function(item), None
+        except Exception as e:
+            return item, None, repr(e)
+
+    results = {}
+    errors = {}
+
+    pool = ThreadPool(min(concurrency, len(unique_items)))
+    try:
+        for item, result, error in pool.imap_unordered(call, unique_items):
+            if error:
+                errors[item] = error
+            else:
+                results[item] = result
+    finally:
+        pool.close()
+        pool.join()
+
+    return results, errors
+
+
+class FileLock(object):
+    """ context manager holding an exclusive lock on a file (does nothing if there is no file or no fcntl) """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def __enter__(self):
+        if self.path and fcntl:
+            self.lock_file = open(self.path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class LocalDatabase(object):
+    """
+    A local SQLite database, created (with its directory) if it doesn't exist. One connection is shared by the batch
+    workers, so access is serialised with self.lock
+    """
+
+    # statements run each time the database is opened, eg CREATE TABLE IF NOT EXISTS
+    schema = []
+
+    def __init__(self, path):
+        """
+        :param path: the SQLite database file
+        """
+
+        self.path = path
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            for statement in self.schema:
+                self.connection.execute(statement)
+            self.connection.commit()
+
+    def close(self):
+        """ close the database """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,106 @@
+"""
+Record of the inputs each PDF was created from, kept in a local SQLite database
+
+For every proband the interpretation request, the highest report version, the highest cip version, a hash of the
+downloaded report and a hash of the LIMS demographics used to build the PDF are stored. When reports are synced
+(gel_report_sync.py) a PDF is only created again if one of these has changed (or the PDF is missing), so reports which
+would be identical to the last run don't go through wkhtmltopdf again.
+"""
+import hashlib
+import json
+import os
+import time
+
+from shared import config, LocalDatabase
+
+
+# the inputs compared between runs, in the order they are stored
+INPUT_COLUMNS = ['ir_id', 'report_version', 'max_cip_ver', 'report_hash', 'lims_hash', 'remove_headers']
+
+
+def report_inputs(ir_id, report_version, max_cip_ver, report, patient_info_dict, remove_headers):
+    """
+    the inputs a PDF is created from, as stored in the sync state
+
+    :param ir_id: the interpretation request id and version (eg 1234-1)
+    :param report_version: the highest clinical report version
+    :param max_cip_ver: the highest cip version of the interpreted genomes
+    :param report: the downloaded report html
+    :param patient_info_dict: the demographics read from the LIMS
+    :param remove_headers: the remove headers flag, which also changes the PDF
+    :return: dictionary of input name: value
+    """
+
+    return {'ir_id': str(ir_id),
+            'report_version': str(report_version),
+            'max_cip_ver': str(max_cip_ver),
+            'report_hash': hashlib.sha1(report).hexdigest(),
+            'lims_hash': hashlib.sha1(json.dumps(patient_info_dict, sort_keys=True, default=str)).hexdigest(),
+            'remove_headers': str(remove_headers)}
+
+
+class SyncState(LocalDatabase):
+    """
+    The inputs of the last PDF created for each proband, stored in a SQLite database
+    """
+
+    schema = ["CREATE TABLE IF NOT EXISTS reports (proband_id TEXT PRIMARY KEY, {}, pdf_path TEXT, updated REAL)".format(
+        ", ".join(column + " TEXT" for column in INPUT_COLUMNS))]
+
+    def get(self, proband_id):
+        """
+        the stored inputs for a proband
+
+        :param proband_id:
+        :return: dictionary of input name: value (plus pdf_path and updated), or None if no PDF has been recorded
+        """
+
+        columns = INPUT_COLUMNS + ['pdf_path', 'updated']
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT {} FROM reports WHERE proband_id = ?".format(", ".join(columns)), (str(proband_id),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(columns, row))
+
+    def unchanged(self, proband_id, inputs, pdf_path):
+        """
+        True if the PDF for this proband was created from the same inputs and still exists
+
+        :param proband_id:
+        :param inputs: dictionary from report_inputs()
+        :param pdf_path: where the PDF should be
+        :return:
+        """
+
+        stored = self.get(proband_id)
+        if stored is None or stored['pdf_path'] != pdf_path or not os.path.isfile(pdf_path):
+            return False
+        return all(stored[column] == inputs[column] for column in INPUT_COLUMNS)
+
+    def record(self, proband_id, inputs, pdf_path):
+        """
+        store the inputs the proband's PDF was created from
+
+        :param proband_id:
+        :param inputs: dictionary from report_inputs()
+        :param pdf_path:
+        """
+
+        values = [str(proband_id)] + [inputs[column] for column in INPUT_COLUMNS] + [pdf_path, time.time()]
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO reports (proband_id, {}, pdf_path, updated) VALUES ({})".format(
+                    ", ".join(INPUT_COLUMNS), ", ".join(["?"] * len(values))), values)
+            self.connection.commit()
+
+
+def open_state(path=None):
+    """
+    open the sync state database
+
+    :param path: defaults to sync_state_db in the config file
+    :return: a SyncState
+    """
+
+    return SyncState(path or config.sync_state_db)
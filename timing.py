@@ -0,0 +1,136 @@
+"""
+Timing and profiling of the stages of creating a report
+
+Each report has a StageTimer which records how long each stage took (authentication, reading the API, downloading the
+report, parsing, each modification, the LIMS, the Jinja render and wkhtmltopdf). When the report is finished the
+timings are appended to the timing log (timing_log in the config file) as one json record per line, so a slow batch
+can be traced to the API, the LIMS or rendering.
+
+A report can also be profiled with cProfile; the stats are written next to the PDF.
+"""
+import cProfile
+import json
+import pstats
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from shared import config
+
+
+# the timing log is shared by all reports in the process
+_log_lock = threading.Lock()
+
+# the kinds of profiling which can be used
+profilers = ['cprofile']
+
+
+class StageTimer(object):
+    """
+    The total time spent in each stage of creating a report
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # stage name: seconds, in the order the stages were first run
+        self.stages = OrderedDict()
+        # stages can run at the same time in different threads
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        time the code run in this with block as the named stage. Time from repeated stages is added together
+
+        :param name: the stage name
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """ add time to a stage """
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def call(self, name, function, *args):
+        """
+        call function(*args), timing it as the named stage
+
+        :param name: the stage name
+        :param function:
+        :return: the return value of function
+        """
+
+        with self.stage(name):
+            return function(*args)
+
+    def record(self, proband_id, status, error=""):
+        """
+        the timings as a dictionary for the timing log
+
+        :param proband_id:
+        :param status: eg created, unchanged or failed
+        :param error: the reason the report wasn't created
+        :return:
+        """
+
+        with self.lock:
+            stages = OrderedDict((name, round(seconds, 4)) for name, seconds in self.stages.items())
+
+        return OrderedDict([('proband_id', proband_id),
+                            ('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+                            ('status', status),
+                            ('error', error),
+                            ('total', round(time.time() - self.started, 4)),
+                            ('stages', stages),
+                            # peak memory use of the whole process (kB on linux)
+                            ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)])
+
+    def write(self, proband_id, status, error="", path=None):
+        """
+        append the timings to the timing log as a single line of json
+
+        :param proband_id:
+        :param status:
+        :param error:
+        :param path: defaults to timing_log in the config file. Nothing is written if neither is set
+        :return: the record
+        """
+
+        record = self.record(proband_id, status, error)
+        path = path or getattr(config, 'timing_log', None)
+        if path:
+            line = json.dumps(record) + '\n'
+            with _log_lock:
+                with open(path, 'a') as log:
+                    log.write(line)
+        return record
+
+
+def profile(kind, path_prefix, function, *args):
+    """
+    run function(*args) under a profiler and write the results to files starting with path_prefix
+
+    :param kind: one of profilers. cprofile writes <path_prefix>.prof (for pstats, snakeviz etc) and
+    <path_prefix>.profile.txt (the 50 functions with the highest cumulative time)
+    :param path_prefix: eg the pdf path without .pdf
+    :param function:
+    :return: the return value of function
+    """
+
+    if kind not in profilers:
+        raise ValueError("unknown profiler {}, must be one of {}".format(kind, ", ".join(profilers)))
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(path_prefix + '.prof')
+        with open(path_prefix + '.profile.txt', 'w') as summary:
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(50)
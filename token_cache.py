@@ -0,0 +1,153 @@
+"""
+Cache of JWT tokens for the CIP-API, shared between threads, runs and processes
+
+Tokens are held in memory and (if a cache file is set in gel_report_config) on disk, so a new token is only requested
+from /get-token/ when the cached one has expired, or is about to. The expiry is read from the 'exp' claim of the token.
+The cache file is locked while it is read and updated, so concurrent processes wait for a single token request
+rather than all requesting their own.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+from shared import config, FileLock, SharedInstance
+
+
+# the cache shared by the whole process, created on first use
+_cache = SharedInstance(lambda: TokenCache(path=getattr(config, 'token_cache', None),
+                                           refresh_margin=getattr(config, 'token_refresh_margin', 60)))
+
+
+def token_expiry(token):
+    """
+    read the expiry time (seconds since the epoch) from the 'exp' claim of a JWT
+
+    :param token: the JWT
+    :return: the expiry time, or None if it can't be read
+    """
+
+    try:
+        payload = token.split('.')[1]
+        # base64 padding is stripped from JWTs
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(str(payload)))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenCache(object):
+    """
+    Tokens cached by key (eg the token url and username), in memory and optionally in a file on disk
+    """
+
+    def __init__(self, path=None, refresh_margin=60, default_lifetime=300):
+        """
+        :param path: file to store the tokens in. If None tokens are only cached in memory
+        :param refresh_margin: request a new token this many seconds before the cached one expires
+        :param default_lifetime: how long to keep a token (in seconds) if the expiry can't be read from it
+        """
+
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+
+        # key: {'token': token, 'expires': seconds since epoch}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, request_token):
+        """
+        returns the cached token for this key, calling request_token() to get a new one if there isn't a valid one cached
+
+        :param key: identifies the credentials the token is for
+        :param request_token: function which requests a new token from the API
+        :return: the token
+        """
+
+        key = self._hash(key)
+
+        with self.lock:
+            if self._valid(self.tokens.get(key)):
+                return self.tokens[key]['token']
+
+            with self._file_lock():
+                # another process may have requested a token since this one last looked
+                self.tokens.update(self._read())
+                if not self._valid(self.tokens.get(key)):
+                    token = request_token()
+                    self.tokens[key] = {'token': token,
+                                        'expires': token_expiry(token) or time.time() + self.default_lifetime}
+                    self._write(key)
+
+            return self.tokens[key]['token']
+
+    def invalidate(self, key, token):
+        """
+        remove a token which has been rejected by the API (eg a 401 response) so the next get() requests a new one.
+        The cached token is only removed if it is the rejected one, as another thread or process may have already replaced it
+
+        :param key: identifies the credentials the token is for
+        :param token: the rejected token
+        """
+
+        key = self._hash(key)
+
+        with self.lock:
+            with self._file_lock():
+                self.tokens.update(self._read())
+                if self.tokens.get(key, {}).get('token') == token:
+                    del self.tokens[key]
+                    self._write(key)
+
+    def _valid(self, entry):
+        """ True if the cached entry exists and isn't about to expire """
+        return entry is not None and entry['expires'] - self.refresh_margin > time.time()
+
+    def _hash(self, key):
+        """ the keys contain usernames so only store a hash of them """
+        return hashlib.sha1(key).hexdigest()
+
+    def _file_lock(self):
+        """ exclusive lock on the cache file, held while it is read and updated """
+        return FileLock(self.path + '.lock' if self.path else None)
+
+    def _read(self):
+        """ read all tokens from the cache file """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            # a corrupt cache file is treated as empty and overwritten on the next write
+            return {}
+
+    def _write(self, key):
+        """ write the entry for this key to the cache file, keeping the entries for other keys """
+        if not self.path:
+            return
+
+        tokens = self._read()
+        if key in self.tokens:
+            tokens[key] = self.tokens[key]
+        else:
+            tokens.pop(key, None)
+
+        # the file contains tokens so is only readable by the user. Write to a temp file then rename so readers never see a partial file
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump(tokens, cache_file)
+        os.rename(temp_path, self.path)
+
+
+def get_cache():
+    """
+    returns the token cache shared by the whole process, created from the config settings on first use
+
+    :return: a TokenCache
+    """
+
+    return _cache.get()
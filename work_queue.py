@@ -0,0 +1,236 @@
+"""
+Work queue for large batches of reports, kept in a local SQLite database
+
+Each proband in a batch (gel_report_batch.py) is recorded here with the state of its report: pending, started,
+fetched (the report has been downloaded and the LIMS read), rendered (the pdf has been created, or was unchanged) or
+failed (with the reason), and the number of attempts. A list of probands is written to the queue before any work starts
+and every change is committed as it happens, so if a batch is interrupted (eg by a proxy outage, a wkhtmltopdf hang or a
+reboot) gel_report_batch.py --resume creates only the reports which hadn't finished, rather than starting the batch
+again. Adding a proband whose report has finished (rendered or failed) makes it pending again, so running a batch again
+creates its reports again, unless the batch is resumed.
+
+Each proband also has a priority. Every batch using the queue takes the pending report with the highest priority next,
+whichever batch added it, so urgent requests started as a second batch (eg gel_report_batch.py -f urgent.txt -u 10)
+are picked up ahead of the backfill by the batches already running. A batch carries on until there are no pending
+reports left.
+"""
+import errno
+import os
+import time
+
+from shared import config, LocalDatabase, SharedInstance
+
+
+# the states of a report
+PENDING = "pending"
+STARTED = "started"
+FETCHED = "fetched"
+RENDERED = "rendered"
+FAILED = "failed"
+
+# reports in these states haven't finished, and are created by a resumed batch
+UNFINISHED = (PENDING, STARTED, FETCHED)
+FINISHED = (RENDERED, FAILED)
+
+# the queue shared by the whole process, created on first use
+_queue = SharedInstance(lambda: WorkQueue(config.work_queue_db), setting='work_queue_db')
+
+
+class WorkQueue(LocalDatabase):
+    """
+    The probands in a batch, with the state of each report
+    """
+
+    # the write ahead log lets a batch update the queue while another adds urgent probands to it
+    schema = ["PRAGMA journal_mode=WAL",
+              "CREATE TABLE IF NOT EXISTS work (proband_id TEXT PRIMARY KEY, priority INTEGER, state TEXT, attempts INTEGER, "
+              "error TEXT, run_id TEXT, added REAL, updated REAL)",
+              "CREATE INDEX IF NOT EXISTS work_pending ON work (state, priority, added)"]
+
+    def __init__(self, path):
+        """
+        :param path: the SQLite database file (created if it doesn't exist)
+        """
+
+        super(WorkQueue, self).__init__(path)
+
+        # the id of the batch using this queue, recorded against the reports it adds and starts
+        self.run_id = "%s-%s" % (time.strftime("%Y%m%d%H%M%S"), os.getpid())
+
+    def add(self, proband_id, priority=0, resume=False):
+        """
+        add a proband to the queue as pending (see add_many)
+
+        :param proband_id:
+        :param priority: higher priorities are created first
+        :param resume: leave the report alone if it has finished
+        :return: the state of the proband's report after it was added
+        """
+
+        with self.lock:
+            state = self._add(proband_id, priority, resume, time.time())
+            self.connection.commit()
+        return state
+
+    def add_many(self, proband_ids, priority=0, resume=False):
+        """
+        add probands to the queue as pending, in a single transaction. A proband already in the queue keeps its
+        attempts, and the higher of its priorities. A proband which is pending, or has been started by a batch which is
+        still running, is left in its current state so it isn't created twice. A proband whose report has finished
+        (rendered or failed) is made pending again, unless the batch is being resumed
+
+        :param proband_ids: list of proband IDs
+        :param priority: higher priorities are created first
+        :param resume: leave the reports which have finished alone, so only the unfinished reports are created
+        :return: list of the proband IDs which were left alone as they had finished
+        """
+
+        now = time.time()
+        finished = []
+        with self.lock:
+            for proband_id in proband_ids:
+                if self._add(proband_id, priority, resume, now) in FINISHED:
+                    finished.append(proband_id)
+            self.connection.commit()
+        return finished
+
+    def _add(self, proband_id, priority, resume, now):
+        """ add a proband (see add_many) without committing. Must be called holding the lock """
+        row = self.connection.execute("SELECT priority, state, run_id FROM work WHERE proband_id = ?", (str(proband_id),)).fetchone()
+        if row is None:
+            self.connection.execute("INSERT INTO work (proband_id, priority, state, attempts, run_id, added, updated) "
+                                    "VALUES (?, ?, ?, 0, ?, ?, ?)", (str(proband_id), priority, PENDING, self.run_id, now, now))
+            return PENDING
+        if row[1] in FINISHED and resume:
+            return row[1]
+        if row[1] == PENDING or (row[1] in UNFINISHED and batch_running(row[2])):
+            self.connection.execute("UPDATE work SET priority = ? WHERE proband_id = ?", (max(row[0], priority), str(proband_id)))
+            return row[1]
+        # rendered, failed or started by a batch which was interrupted
+        self.connection.execute("UPDATE work SET priority = ?, state = ?, error = NULL, run_id = ?, updated = ? "
+                                "WHERE proband_id = ?", (max(row[0], priority), PENDING, self.run_id, now, str(proband_id)))
+        return PENDING
+
+    def resume(self):
+        """
+        take over the unfinished reports from earlier (interrupted) batches: those which are pending, and those which
+        had been started by a batch which is no longer running. Reports which had been started are created again from
+        the beginning. Reports started by a batch which is still running are left to it
+
+        :return: the number of reports resumed
+        """
+
+        count = 0
+        with self.lock:
+            rows = self.connection.execute("SELECT proband_id, state, run_id FROM work WHERE state IN (?, ?, ?)", UNFINISHED).fetchall()
+            for proband_id, state, run_id in rows:
+                if state == PENDING or not batch_running(run_id):
+                    count += self.connection.execute("UPDATE work SET state = ?, run_id = ? WHERE proband_id = ? AND state = ?",
+                                                     (PENDING, self.run_id, proband_id, state)).rowcount
+            self.connection.commit()
+        return count
+
+    def next(self):
+        """
+        start the pending report with the highest priority (those added first if the priorities are the same),
+        whichever batch added it
+
+        :return: the proband ID, or None if there are no pending reports
+        """
+
+        with self.lock:
+            while True:
+                row = self.connection.execute("SELECT proband_id FROM work WHERE state = ? "
+                                              "ORDER BY priority DESC, added, rowid LIMIT 1", (PENDING,)).fetchone()
+                if row is None:
+                    return None
+                # another batch may have started the report since it was selected, in which case try the next one
+                started = self.connection.execute("UPDATE work SET state = ?, run_id = ?, attempts = attempts + 1, updated = ? "
+                                                  "WHERE proband_id = ? AND state = ?",
+                                                  (STARTED, self.run_id, time.time(), row[0], PENDING)).rowcount
+                self.connection.commit()
+                if started:
+                    return row[0]
+
+    def probands(self, proband_ids=(), priority=0, resume=False):
+        """
+        add the proband IDs to the queue and start the pending reports in priority order, until there are none left.
+        The proband IDs are added one at a time as they are needed, so a generator (eg the cases read from the API)
+        isn't read all at once. A list should be added with add_many first, so it is all in the queue if the batch is
+        interrupted
+
+        :param proband_ids: list (or generator) of proband IDs
+        :param priority:
+        :param resume: leave the reports which have finished alone
+        :return: generator of proband IDs
+        """
+
+        proband_ids = iter(proband_ids)
+        more = True
+        while True:
+            if more:
+                proband_id = next(proband_ids, None)
+                if proband_id is None:
+                    more = False
+                else:
+                    self.add(proband_id, priority, resume)
+            proband_id = self.next()
+            if proband_id is not None:
+                yield proband_id
+            elif not more:
+                return
+
+    def update(self, proband_id, state, error=None):
+        """
+        record the state of a report
+
+        :param proband_id:
+        :param state: eg FETCHED
+        :param error: why the report failed
+        """
+
+        with self.lock:
+            self.connection.execute("UPDATE work SET state = ?, error = ?, updated = ? WHERE proband_id = ?",
+                                    (state, error, time.time(), str(proband_id)))
+            self.connection.commit()
+
+    def counts(self):
+        """
+        the number of reports in each state
+
+        :return: dictionary of state: count
+        """
+
+        with self.lock:
+            return dict(self.connection.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+
+
+def batch_running(run_id):
+    """
+    True if the batch with this id is still running. The id contains the process ID of the batch (the queue is a local
+    database, so the batches using it run on this machine)
+
+    :param run_id: eg 20240101120000-1234
+    :return:
+    """
+
+    try:
+        pid = int(run_id.rsplit("-", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means the process exists but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_queue():
+    """
+    returns the work queue shared by the whole process, or None if work_queue_db isn't set in the config file
+
+    :return: a WorkQueue or None
+    """
+
+    return _queue.get()